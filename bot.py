@@ -7,7 +7,8 @@ except ImportError:
 
 from cogs import account, help, tips, tip_legacy, stats, rain, admin, useroptions, favorites, spy, giveaway
 from config import Config
-from discord.ext.commands import Bot
+from discord.ext.commands import AutoShardedBot
+from db.models.stats import Stats
 from db.models.transaction import Transaction
 from db.tortoise_config import DBConfig
 from db.redis import RedisDB
@@ -21,12 +22,19 @@ from version import __version__
 
 import sys
 import asyncio
+import datetime
 import discord
 intents = discord.Intents.default()
 intents.members = True
 intents.presences = True
 import logging
 from rpc.client import RPCClient
+from tasks.account_pool import AccountPool
+from tasks.activity_buffer import ActivityBuffer
+from tasks.cluster import Cluster
+from tasks.dm_queue import DMQueue
+from tasks.leader_election import LeaderElection
+from tasks.receive_scheduler import ReceiveScheduler
 from tasks.transaction_queue import TransactionQueue
 
 # Configuration
@@ -39,21 +47,28 @@ subID = f"{config.bot_token}:deposits"
 setup_logger(config.log_file, log_level=logging.DEBUG if config.debug else logging.INFO)
 logger = logging.getLogger()
 
-# TODO - re-enable for discord.py 1.5.0
-client = Bot(command_prefix=config.command_prefix, intents=intents)
+# Shards may be spread over several processes, each of them only sees the guilds of its own shards
+client = AutoShardedBot(command_prefix=config.command_prefix, intents=intents, shard_count=config.get_shard_count(), shard_ids=config.get_shard_ids())
 client.remove_command('help')
 
-# Periodic re-queue tranasctions
-async def reQueueTransactions(client):
+# Process any transactions in our DB that are outstanding, whenever we become the leader
+async def queueUnprocessedTransactions():
+	logger.info(f"Re-queueing any unprocessed transactions")
+	unprocessed_txs = await Transaction.get_unprocessed()
+	for tx in unprocessed_txs:
+		await TransactionQueue.instance(bot=client).put(tx)
+	logger.info(f"Re-queued {len(unprocessed_txs)} transactions")
+
+# Yearly reset of the ballers list
+async def resetStatsYearly():
 	while True:
-		logger.info(f"Re-queue task started")
-		await asyncio.sleep(600)
-		logger.info(f"Re-queue task running")
-		TransactionQueue.instance(bot=client).clear()
-		unprocessed_txs = await Transaction.filter(block_hash=None, destination__not_isnull=True).all().prefetch_related('sending_user', 'receiving_user')
-		for tx in unprocessed_txs:
-			await TransactionQueue.instance(bot=client).put(tx)
-		logger.info(f"Re-queued {len(unprocessed_txs)} transactions")
+		reset_count = await Stats.reset_yearly()
+		if reset_count > 0:
+			logger.info(f"Reset yearly stats of {reset_count} users")
+		# Check again at the start of next year
+		now = datetime.datetime.now(datetime.timezone.utc)
+		next_year = datetime.datetime(now.year + 1, 1, 1, tzinfo=datetime.timezone.utc)
+		await asyncio.sleep(min((next_year - now).total_seconds() + 1, 86400))
 
 ### Bot events
 
@@ -63,14 +78,26 @@ async def on_ready():
 	logger.info(f"Discord.py version {discord.__version__}")
 	logger.info(f"Bot name: {client.user.name}")
 	logger.info(f"Bot Discord ID: {client.user.id}")
+	logger.info(f"Shards: {'all' if client.shard_ids is None else client.shard_ids} of {client.shard_count}")
 	await client.change_presence(activity=discord.Game(config.playing_status))
 
-	# Process any transactions in our DB that are outstanding
-	logger.info(f"Re-queueing any unprocessed transactions")
-	unprocessed_txs = await Transaction.filter(block_hash=None, destination__not_isnull=True).all().prefetch_related('sending_user', 'receiving_user')
-	for tx in unprocessed_txs:
-		await TransactionQueue.instance(bot=client).put(tx)
-	logger.info(f"Re-queued {len(unprocessed_txs)} transactions")
+# Role admins are looked up by every process, whichever shard their guild is on
+@client.event
+async def on_guild_available(guild: discord.Guild):
+	await Cluster.instance(client).sync_admin_roles(guild)
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+	await RedisDB.instance().admin_roles_set(guild.id, [])
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+	if before.roles != after.roles:
+		await Cluster.instance(client).update_admin_roles(after)
+
+@client.event
+async def on_member_remove(member: discord.Member):
+	await Cluster.instance(client).update_admin_roles(member, has_role=False)
 
 @client.event
 async def on_message(message: discord.Message):
@@ -80,12 +107,17 @@ async def on_message(message: discord.Message):
     # Process commands
 	await client.process_commands(message)
 
-async def deposit_notification_sub(ch):
-	while (await ch.wait_message()):
-		msg = await ch.get_json()
-		discord_user = await client.fetch_user(msg["id"])
-		if discord_user is not None:
-			await Messages.send_success_dm(discord_user, msg["message"], header="Deposit Success", footer=f"I only notify you of deposits that are {10 if Env.banano() else 0.1} {Env.currency_symbol()} or greater.")
+async def deposit_notification_sub():
+	redis = await RedisDB.instance().get_redis()
+	ch, = await redis.subscribe(subID)
+	try:
+		while (await ch.wait_message()):
+			msg = await ch.get_json()
+			discord_user = await client.fetch_user(msg["id"])
+			if discord_user is not None:
+				await Messages.send_success_dm(discord_user, msg["message"], header="Deposit Success", footer=f"I only notify you of deposits that are {10 if Env.banano() else 0.1} {Env.currency_symbol()} or greater.")
+	finally:
+		await redis.unsubscribe(subID)
 
 async def start_bot():
 	# Add cogs
@@ -102,17 +134,28 @@ async def start_bot():
 	if not Env.banano():
 		# Add a command to warn users that tip unit has changed
 		client.add_cog(tip_legacy.TipLegacyCog(client))
-	redis = await RedisDB.instance().get_redis()
-	sub = await redis.subscribe(subID)		
+	cluster = Cluster.instance(bot=client)
 	# Start bot
 	try:
 		# Initialize database first
 		logger.info("Initializing database")
 		await DBConfig().init_db()
-		asyncio.create_task(TransactionQueue.instance(bot=client).queue_consumer())
-		asyncio.create_task(reQueueTransactions(client))
+		asyncio.create_task(cluster.listen())
+		asyncio.create_task(ActivityBuffer.instance().flush_loop())
+		# Work that must only run once, other processes hand transactions and DMs over through redis
+		election = LeaderElection.instance()
+		election.add_worker(TransactionQueue.instance(bot=client).queue_consumer)
+		election.add_worker(TransactionQueue.instance(bot=client).redeliver_loop)
+		election.add_worker(queueUnprocessedTransactions)
+		election.add_worker(DMQueue.instance(bot=client).queue_consumer)
+		election.add_worker(resetStatsYearly)
+		election.add_worker(AccountPool.instance().refill_loop)
+		election.add_worker(ReceiveScheduler.instance().receive_loop)
+		election.add_worker(ReceiveScheduler.instance().queue_consumer)
 		# Listen for deposit notifications
-		asyncio.create_task(deposit_notification_sub(sub[0]))
+		election.add_worker(deposit_notification_sub)
+		election.add_worker(client.get_cog('GiveawayCog').giveaway_scheduler)
+		asyncio.create_task(election.run())
 		await client.start(config.bot_token),
 	except Exception:
 		logger.exception("Graham exited with exception")
@@ -120,9 +163,10 @@ async def start_bot():
 		pass
 	finally:
 		logger.info("Graham is exiting")
+		await LeaderElection.instance().resign()
 		await client.logout()
 		await RPCClient.close()
-		await sub.unsubscribe(subID)
+		await ActivityBuffer.instance().flush()
 		await RedisDB.close()
 
 def start_server():
@@ -8,26 +8,40 @@ import os
 from models.constants import Constants
 from db.tortoise_config import DBConfig
 from db.models.account import Account
+from db.models.user import User
 from rpc.client import RPCClient
 
 parser = argparse.ArgumentParser(description="Utilities for Graham")
 parser.add_argument('-r', '--representative-fix', action='store_true',  help='Set representative for all bot accounts')
+parser.add_argument('--rebuild-pending', action='store_true',  help='Recompute the pending balance ledger of all users, the bot should be stopped')
 options, unknown = parser.parse_known_args()
 
 async def rep_fix():
     print("Starting rep set routine")
     await DBConfig().init_db()
     accounts = await Account.all()
-    for a in accounts:
-        # Get account info
-        acct_info = await RPCClient.instance().account_info(a.address)
-        if acct_info is not None and 'representative' in acct_info and acct_info['representative'] != Constants.REPRESENTATIVE:
-            print(f"Setting rep for {a.address}")
-            hash = await RPCClient.instance().account_representative_set(a.address, Constants.REPRESENTATIVE)
-            if hash is not None:
-                print(f"Set rep {hash}")
-            else:
-                print("Failed to set rep")
+    addresses = [a.address for a in accounts]
+    for i in range(0, len(addresses), 1000):
+        chunk = addresses[i:i + 1000]
+        # Get representatives in bulk, fall back to account_info on nodes without accounts_representatives
+        reps = await RPCClient.instance().accounts_representatives(chunk)
+        if reps is None:
+            infos = await asyncio.gather(*[RPCClient.instance().account_info(a) for a in chunk])
+            reps = {a: info['representative'] for a, info in zip(chunk, infos) if info is not None and 'representative' in info}
+        for address, rep in reps.items():
+            if rep != Constants.REPRESENTATIVE:
+                print(f"Setting rep for {address}")
+                hash = await RPCClient.instance().account_representative_set(address, Constants.REPRESENTATIVE)
+                if hash is not None:
+                    print(f"Set rep {hash}")
+                else:
+                    print("Failed to set rep")
+    print("Done")
+
+async def rebuild_pending():
+    print("Rebuilding pending ledger")
+    await DBConfig().init_db()
+    await User.rebuild_pending()
     print("Done")
 
 if __name__ == '__main__':
@@ -36,6 +50,10 @@ if __name__ == '__main__':
         loop = asyncio.new_event_loop()
         loop.run_until_complete(rep_fix())
         loop.close()
+    elif options.rebuild_pending:
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(rebuild_pending())
+        loop.close()
     else:
         parser.print_help()
     exit(0)
\ No newline at end of file
@@ -8,6 +8,7 @@ from db.models.transaction import Transaction
 from db.models.user import User
 from db.redis import RedisDB
 from rpc.client import RPCClient
+from tasks.receive_scheduler import ReceiveScheduler
 from tasks.transaction_queue import TransactionQueue
 from util.env import Env
 from util.regex import RegexUtil, AmountMissingException, AmountAmbiguousException, AddressAmbiguousException, AddressMissingException
@@ -179,7 +180,7 @@ class AccountCog(commands.Cog):
             pending_send_db, pending_receive_db = await user.get_pending()
             embed = self.format_balance_message(balance_raw, pending_raw, pending_send_db, pending_receive_db)
             sent = await msg.author.send(embed=embed)
-            if pending_raw >= 1000000000000000000000000000:
+            if pending_raw >= ReceiveScheduler.instance().threshold:
                 # Pocket some transactions and update their balance
                 asyncio.ensure_future(
                     self.pocket_pendings(
@@ -197,19 +198,12 @@ class AccountCog(commands.Cog):
         # Check if they've done this recently to avoid spam
         if await RedisDB.instance().exists(f"pocketpendingspam:{dbuser.id}"):
             return
-        # Check for pendings
-        pendings = await RPCClient.instance().pending(address)
-        should_update_balance = False
-        if pendings is None or len(pendings) == 0:
-            return
         # Update spam flag
         await RedisDB.instance().set(f"pocketpendingspam:{dbuser.id}", "as", expires=60)
-        # Pocket pendings
-        for p in pendings:
-            if await RPCClient.instance().receive(address, p) is not None:
-                should_update_balance = True
+        # Pocket pendings, unless the background receiver is already on it
+        received = await ReceiveScheduler.instance().receive_account(address)
         # Update their balance message
-        if should_update_balance:
+        if received > 0:
             # Update balance
             balance_json = await RPCClient.instance().account_balance(address, True)
             if balance_json is None:
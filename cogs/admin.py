@@ -1,13 +1,19 @@
 from discord.ext import commands
 from discord.ext.commands import Bot, Context
 from db.models.stats import Stats
+from db.models.transaction import DeadLetter
 from db.models.user import User
 from db.redis import RedisDB
 from models.command import CommandInfo
+from rpc.client import RPCClient
+from tasks.cluster import Cluster
+from tasks.transaction_queue import TransactionQueue
+from tortoise.exceptions import DoesNotExist, IntegrityError
 from tortoise.transactions import in_transaction
 
 import config
 import logging
+import uuid
 from util.discord.messages import Messages
 from util.discord.paginator import Entry, Page, Paginator
 from util.discord.channel import ChannelUtil
@@ -80,6 +86,21 @@ INCREASETIPS_INFO = CommandInfo(
     overview = "Increase tip stat total",
     details = f"`{config.Config.instance().command_prefix}increasetips 1000 @bbedward` - Increase users tip count by 1000 {Env.currency_name()}"
 )
+DEADLETTERS_INFO = CommandInfo(
+    triggers = ["deadletters"],
+    overview = "Get a list of failed transactions",
+    details = "Lists transactions that were given up on after failing to send too many times."
+)
+REPLAY_INFO = CommandInfo(
+    triggers = ["replay"],
+    overview = "Retry failed transactions",
+    details = f"`{config.Config.instance().command_prefix}replay <transaction_id>` - Retry a transaction from the dead letters, or all of them with `{config.Config.instance().command_prefix}replay all`"
+)
+NODESTATS_INFO = CommandInfo(
+    triggers = ["nodestats"],
+    overview = "Show node connection stats",
+    details = "Shows health, latency and connection pool usage of every node the bot talks to."
+)
 
 class AdminCog(commands.Cog):
     """Commands for admins only"""
@@ -103,6 +124,9 @@ class AdminCog(commands.Cog):
                             break
                 if ctx.admin:
                     break
+            if not ctx.admin:
+                # Their guild may be on a shard run by another process
+                ctx.admin = await Cluster.instance().is_role_admin(msg.author.id)
         else:
             ctx.admin = True
 
@@ -174,6 +198,7 @@ class AdminCog(commands.Cog):
             return
 
         await User.filter(id__in=freeze_ids).update(frozen=True)
+        await User.invalidate_cache(freeze_ids)
 
         await msg.author.send(f"{len(freeze_ids)} users have been frozen")
         await msg.add_reaction("\U0001F9CA")
@@ -211,6 +236,7 @@ class AdminCog(commands.Cog):
         # TODO - tortoise doesnt give us any feedback on update counts atm
         # https://github.com/tortoise/tortoise-orm/issues/126
         await User.filter(id__in=freeze_ids).update(frozen=False)
+        await User.invalidate_cache(freeze_ids)
 
         await msg.author.send(f"{len(freeze_ids)} users have been defrosted")
         await msg.add_reaction("\U0001F525")
@@ -298,6 +324,7 @@ class AdminCog(commands.Cog):
             return
 
         await User.filter(id__in=ban_ids).update(tip_banned=True)
+        await User.invalidate_cache(ban_ids)
 
         await msg.author.send(f"{len(ban_ids)} users have been banned")
         await msg.add_reaction("\U0001F528")
@@ -335,6 +362,7 @@ class AdminCog(commands.Cog):
         # TODO - tortoise doesnt give us any feedback on update counts atm
         # https://github.com/tortoise/tortoise-orm/issues/126
         await User.filter(id__in=ban_ids).update(tip_banned=False)
+        await User.invalidate_cache(ban_ids)
 
         await msg.author.send(f"{len(ban_ids)} users have been unbanned")
         await msg.add_reaction("\U0001F5FD")
@@ -427,6 +455,8 @@ class AdminCog(commands.Cog):
                 stats = await u.get_stats(msg.guild.id)
                 stats.banned = True
                 await stats.save(update_fields=['banned'], using_db=conn)
+        await RedisDB.instance().leaderboard_remove(msg.guild.id, [u.id for u in to_ban])
+        await RedisDB.instance().delete(f"toptips:{msg.guild.id}")
 
         await msg.author.send(f"{len(ban_ids)} users have been banned")
         await msg.add_reaction("\U0001F528")
@@ -469,6 +499,7 @@ class AdminCog(commands.Cog):
         # TODO - tortoise doesnt give us any feedback on update counts atm
         # https://github.com/tortoise/tortoise-orm/issues/126
         await Stats.filter(user_id__in=ban_ids, server_id=msg.guild.id, banned=True).update(banned=False)
+        await Stats.invalidate_leaderboards(msg.guild.id)
 
         await msg.author.send(f"{len(ban_ids)} users have been unbanned")
         await msg.add_reaction("\U0001F5FD")
@@ -563,6 +594,7 @@ class AdminCog(commands.Cog):
                 u.legacy_total_tipped_amount = float(u.legacy_total_tipped_amount) - amount
                 await u.save(using_db=conn, update_fields=['total_tipped_amount', 'legacy_total_tipped_amount'])
                 decrease_tip_count += 1
+        await Stats.invalidate_leaderboards(msg.guild.id)
 
         await msg.author.send(f"Decreased stats of {decrease_tip_count} by {amount} {Env.currency_name()}")
         await msg.add_reaction("\u2796")
@@ -612,6 +644,105 @@ class AdminCog(commands.Cog):
                 u.legacy_total_tipped_amount = float(u.legacy_total_tipped_amount) + amount
                 await u.save(using_db=conn, update_fields=['total_tipped_amount', 'legacy_total_tipped_amount'])
                 increase_tip_count += 1
+        await Stats.invalidate_leaderboards(msg.guild.id)
 
         await msg.author.send(f"Increased stats of {increase_tip_count} by {amount} {Env.currency_name()}")
         await msg.add_reaction("\u2795")
+
+    @commands.command(aliases=DEADLETTERS_INFO.triggers)
+    async def deadletters_cmd(self, ctx: Context):
+        if ctx.error:
+            return
+
+        msg = ctx.message
+
+        dead_letters = await DeadLetter.get_all()
+
+        if len(dead_letters) < 1:
+            await msg.author.send("There aren't any failed transactions")
+            return
+
+        # Build transaction list
+        entries = []
+        for d in dead_letters:
+            tx = d.transaction
+            entries.append(Entry(
+                f"{tx.id}",
+                f"{Env.raw_to_amount(int(tx.amount))} {Env.currency_symbol()} from {tx.sending_user.id}:{tx.sending_user.name} to {tx.destination}, failed {d.attempts} times"
+            ))
+
+        # Build pages
+        pages = []
+        # Overview
+        author="Failed Transactions"
+        description = f"Use `{config.Config.instance().command_prefix}replay <transaction_id>` to retry a transaction"
+        i = 0
+        entry_subset = []
+        for e in entries:
+            entry_subset.append(e)
+            if i == 14:
+                pages.append(Page(entries=entry_subset, author=author, description=description))
+                i = 0
+                entry_subset = []
+            else:
+                i += 1
+        if len(entry_subset) > 0:
+            pages.append(Page(entries=entry_subset, author=author, description=description))
+
+        # Start pagination
+        pages = Paginator(self.bot, message=msg, page_list=pages,as_dm=True)
+        await pages.paginate(start_page=1)
+
+    @commands.command(aliases=REPLAY_INFO.triggers)
+    async def replay_cmd(self, ctx: Context):
+        if ctx.error:
+            return
+
+        msg = ctx.message
+
+        tx_ids = msg.content.split()[1:]
+        if len(tx_ids) < 1:
+            await Messages.send_usage_dm(msg.author, REPLAY_INFO)
+            return
+
+        if 'all' in tx_ids:
+            tx_ids = None
+        else:
+            try:
+                tx_ids = [str(uuid.UUID(tx_id)) for tx_id in tx_ids]
+            except ValueError:
+                await Messages.add_x_reaction(msg)
+                await msg.author.send("Those don't look like transaction IDs")
+                return
+
+        try:
+            txs = await DeadLetter.replay(tx_ids)
+        except (DoesNotExist, IntegrityError):
+            await Messages.add_x_reaction(msg)
+            await msg.author.send(f"Those transactions changed while replaying them, check `{config.Config.instance().command_prefix}deadletters` and try again")
+            return
+        except Exception:
+            self.logger.exception("Failed to replay dead letters")
+            await Messages.add_x_reaction(msg)
+            await msg.author.send("I couldn't replay those transactions, check the logs")
+            return
+        await TransactionQueue.instance().put_all(txs)
+
+        await msg.author.send(f"Re-queued {len(txs)} failed transactions")
+        await msg.add_reaction("\u2705")
+
+    @commands.command(aliases=NODESTATS_INFO.triggers)
+    async def nodestats_cmd(self, ctx: Context):
+        if ctx.error:
+            return
+
+        msg = ctx.message
+
+        response = ""
+        for url, stats in RPCClient.instance().get_stats().items():
+            response += f"**{url}** ({stats['state']})\n```"
+            response += f"Latency: {stats['latency'] * 1000:.0f}ms, errors: {stats['error_rate'] * 100:.0f}%\n"
+            response += f"Requests: {stats['requests']}, in flight: {stats['in_flight']}/{stats['limit']}\n"
+            response += f"Waiting for a connection: {stats['queued']} now, {stats['queued_total']} total, {stats['queue_wait'] * 1000:.0f}ms on average\n"
+            response += f"Connections opened: {stats['connections_created']}, reused: {stats['connections_reused']}```\n"
+        await msg.author.send(response)
@@ -261,7 +261,7 @@ class FavoriteCog(commands.Cog):
             return
 
         # Get their favorites
-        favorites = await Favorite.filter(user=user).prefetch_related('favorited_user').all()
+        favorites = await Favorite.filter(user=user).prefetch_related('favorited_user__account').all()
         if len(favorites) < 1:
             await Messages.add_x_reaction(msg)
             await Messages.send_error_dm(msg.author, "You don't have any favorites, add some first.")
@@ -282,24 +282,21 @@ class FavoriteCog(commands.Cog):
             return
 
         # Make the transactions in the database
-        tx_list = []
+        tx_list = await Transaction.create_transactions_internal_dbuser(
+            sending_user=user,
+            amount=individual_send_amount,
+            receiving_users=[u.favorited_user for u in favorites]
+        )
+        muted_by_ids = await user.get_muted_by_ids()
         task_list = []
-
         for u in favorites:
-            tx = await Transaction.create_transaction_internal_dbuser(
-                sending_user=user,
-                amount=individual_send_amount,
-                receiving_user=u.favorited_user
-            )
-            if tx is not None:
-                tx_list.append(tx)
-                if not await user.is_muted_by(u.favorited_user.id):
-                    task_list.append(
-                        Messages.send_basic_dm(
-                            member=self.bot.get_user(u.favorited_user.id),
-                            message=f"You were tipped **{individual_send_amount} {Env.currency_symbol()}** by {msg.author.name.replace('`', '')}.\nUse `{config.Config.instance().command_prefix}mute {msg.author.id}` to disable notifications for this user."
-                        )
+            if u.favorited_user.id not in muted_by_ids:
+                task_list.append(
+                    Messages.send_basic_dm(
+                        member=self.bot.get_user(u.favorited_user.id),
+                        message=f"You were tipped **{individual_send_amount} {Env.currency_symbol()}** by {msg.author.name.replace('`', '')}.\nUse `{config.Config.instance().command_prefix}mute {msg.author.id}` to disable notifications for this user."
                     )
+                )
         if len(tx_list) < 1:
             await Messages.add_x_reaction(msg)
             await Messages.send_error_dm(msg.author, f"No users you mentioned are eligible to receive tips.")
@@ -309,8 +306,7 @@ class FavoriteCog(commands.Cog):
         # Add reactions
         await Messages.add_tip_reaction(msg, amount_needed)
         # Queue the actual sends
-        for tx in tx_list:
-            await TransactionQueue.instance().put(tx)
+        await TransactionQueue.instance().put_all(tx_list)
         # anti spam
         await RedisDB.instance().set(f"tipfavoritesspam{msg.author.id}", "as", expires=300)
         # Update stats
@@ -1,8 +1,10 @@
 from aioredis_lock import RedisLock, LockTimeoutError
 from discord.ext import commands
 from discord.ext.commands import Bot, Context
+from tortoise.exceptions import OperationalError
 from tortoise.transactions import in_transaction
 from models.command import CommandInfo
+from rpc.client import NodeUnavailableException
 from util.env import Env
 from util.discord.messages import Messages
 from util.regex import RegexUtil, AmountMissingException
@@ -11,6 +13,7 @@ from db.models.giveaway import Giveaway
 from db.models.transaction import Transaction
 from db.models.user import User
 
+import aioredis
 import asyncio
 import config
 import datetime
@@ -18,8 +21,10 @@ import discord
 import logging
 import secrets
 import random
+import time
 from util.discord.channel import ChannelUtil
 from db.redis import RedisDB
+from tasks.cluster import Cluster
 from tasks.transaction_queue import TransactionQueue
 from util.validators import Validators
 from util.util import Utils
@@ -71,17 +76,31 @@ class GiveawayCog(commands.Cog):
     def __init__(self, bot: Bot):
         self.bot = bot
         self.logger = logging.getLogger()
-        self.giveaway_ids = []
-
-    @commands.Cog.listener()
-    async def on_ready(self):
-        # Get active giveaways
-        self.logger.info("Checking for active giveaways")
-        for guild in self.bot.guilds:
-            gw = await Giveaway.get_active_giveaway(server_id=guild.id)
-            if gw is not None:
-                self.logger.info(f"Resuming giveaway {gw.id}")
-                asyncio.create_task(self.start_giveaway_timer(gw))
+
+    async def schedule_giveaway(self, giveaway: Giveaway):
+        """Have the scheduler end a giveaway at its end_at"""
+        await RedisDB.instance().giveaway_schedule(giveaway.id, giveaway.end_at.timestamp())
+
+    async def giveaway_scheduler(self):
+        """End giveaways when they're due, only the leader process runs this"""
+        await self.bot.wait_until_ready()
+        # Put back anything redis doesn't know about
+        giveaways = await Giveaway.get_active_giveaways()
+        self.logger.info(f"Scheduling {len(giveaways)} active giveaways")
+        for gw in giveaways:
+            await self.schedule_giveaway(gw)
+        while True:
+            try:
+                for giveaway_id in await RedisDB.instance().giveaway_take_due():
+                    gw = await Giveaway.get_active_giveaway_by_id(giveaway_id)
+                    if gw is not None:
+                        asyncio.create_task(self.end_scheduled_giveaway(gw))
+                # Giveaways can be started by any process, so check at least every second
+                next_due = await RedisDB.instance().giveaway_next_due()
+                await asyncio.sleep(1 if next_due is None else min(1, max(0, next_due - time.time())))
+            except Exception:
+                self.logger.exception("Error in giveaway scheduler")
+                await asyncio.sleep(1)
 
     async def cog_before_invoke(self, ctx: Context):
         ctx.error = False
@@ -137,7 +156,7 @@ class GiveawayCog(commands.Cog):
         if not can_participate:
             role_names = []
             for role_id in giveaway_roles:
-                role: discord.Role = msg.guild.get_role(role_id)
+                role: discord.Role = msg.author.guild.get_role(role_id)
                 if role is not None:
                     role_names.append(role.name)
             resp_str = ""
@@ -172,58 +191,53 @@ class GiveawayCog(commands.Cog):
         embed.description += "\nGood luck! \U0001F340"
         return embed
 
-    async def start_giveaway_timer(self, giveaway: Giveaway):
-        # Ensure timer not already started
-        if giveaway.id in self.giveaway_ids:
-            return
-        self.giveaway_ids.append(giveaway.id)
-        # Sleep for <giveaway duration> seconds
-        delta = (giveaway.end_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
-        if delta > 0:
-            await asyncio.sleep(delta)
-        # End the giveaway
-        # Get entries
-        txs = await Transaction.filter(giveaway=giveaway).prefetch_related('sending_user').all()
-        users = []
-        for tx in txs:
-            if tx.sending_user not in users and int(tx.amount) >= int(giveaway.entry_fee):
-                users.append(tx.sending_user)
-        # Pick winner
-        random.shuffle(users, Utils.random_float)
-        winner = secrets.choice(users)
-        # Calculate total winning amount
-        tx_sum = 0
-        for tx in txs:
-            tx_sum += int(tx.amount)
-        # Finish this
+    async def end_scheduled_giveaway(self, giveaway: Giveaway):
+        try:
+            await self.end_giveaway(giveaway)
+        except (OperationalError, aioredis.RedisError, NodeUnavailableException, ConnectionError, asyncio.TimeoutError):
+            self.logger.exception(f"Failed to end giveaway {giveaway.id}, trying again in a minute")
+            await RedisDB.instance().giveaway_schedule(giveaway.id, time.time() + 60)
+        except Exception:
+            self.logger.exception(f"Failed to end giveaway {giveaway.id}")
+
+    async def announce_without_winner(self, giveaway: Giveaway):
+        embed = discord.Embed(colour=0xFBDD11 if Env.banano() else discord.Colour.dark_blue())
+        embed.set_author(name="No winner this time!", icon_url="https://github.com/bbedward/graham_discord_bot/raw/master/assets/banano_logo.png" if Env.banano() else "https://github.com/bbedward/graham_discord_bot/raw/master/assets/nano_logo.png")
+        embed.description = f"Giveaway #{giveaway.id} ended without anyone entering it, all donations have been returned."
+        await Cluster.instance().announce([giveaway.started_in_channel], embed)
+
+    async def end_giveaway(self, giveaway: Giveaway):
         async with in_transaction() as conn:
             giveaway.ended_at = datetime.datetime.now(datetime.timezone.utc)
-            giveaway.winning_user = winner
-            giveaway.final_amount = str(tx_sum)
-            await giveaway.save(using_db=conn, update_fields=['ended_at', 'winning_user_id', 'final_amount'])
-            # Update transactions
-            winner_account = await winner.get_address()
-            for tx in txs:
-                if tx.amount == '0':
-                    await tx.delete()
-                else:
-                    tx.destination = winner_account
-                    tx.receiving_user = winner
-                    await tx.save(using_db=conn, update_fields=['receiving_user_id', 'destination'])
+            # Another process may have ended it already, the giveaway stays locked until this is done
+            if await Giveaway.filter(id=giveaway.id, ended_at=None, winning_user=None).using_db(conn).update(ended_at=giveaway.ended_at) == 0:
+                return
+            # Get entries
+            entrant_ids, _ = await Transaction.get_giveaway_entries(giveaway.id, int(giveaway.entry_fee), conn=conn)
+            if len(entrant_ids) == 0:
+                # Nobody paid the entry fee, everyone gets their donation back
+                refunded = await Transaction.refund_giveaway(conn, giveaway.id)
+                winner = None
+            else:
+                # Pick winner
+                random.shuffle(entrant_ids, Utils.random_float)
+                winner = await User.get_user_id(secrets.choice(entrant_ids))
+                txs = await Transaction.settle_giveaway(conn, giveaway.id, winner)
+                # Whatever was settled, entries may have come in since they were counted
+                tx_sum = sum(int(tx.amount_raw) for tx in txs)
+                giveaway.winning_user = winner
+                giveaway.final_amount = str(tx_sum)
+                await Giveaway.filter(id=giveaway.id).using_db(conn).update(
+                    winning_user_id=winner.id,
+                    final_amount=giveaway.final_amount
+                )
+        if winner is None:
+            self.logger.info(f"Giveaway {giveaway.id} ended without entrants, refunded {refunded} transactions")
+            await self.announce_without_winner(giveaway)
+            return
         # Queue transactions
-        for tx in txs:
-            await TransactionQueue.instance().put(tx)
+        await TransactionQueue.instance().put_all(txs)
         # Announce winner
-        main_channel = self.bot.get_channel(giveaway.started_in_channel)
-        announce_channels = []
-        if main_channel is not None:
-            announce_channels.append(main_channel)
-        for ch in config.Config.instance().get_giveaway_announce_channels():
-            if ch == giveaway.started_in_channel:
-                continue
-            dch = self.bot.get_channel(ch)
-            if dch is not None:
-                announce_channels.append(dch)
 
         ann_message = f"Congratulations! <@{winner.id}> was the winner of the giveaway!"
         ann_message+= f"\nThey have been sent **{Env.raw_to_amount(tx_sum)} {Env.currency_symbol()}**"
@@ -233,20 +247,16 @@ class GiveawayCog(commands.Cog):
         embed.set_author(name="We have a winner!", icon_url="https://github.com/bbedward/graham_discord_bot/raw/master/assets/banano_logo.png" if Env.banano() else "https://github.com/bbedward/graham_discord_bot/raw/master/assets/nano_logo.png")
         embed.description = ann_message
 
-        for ann in announce_channels:
-            try:
-                await ann.send(embed=embed)
-            except Exception:
-                pass
+        # The channels may belong to shards run by other processes
+        announce_channels = [giveaway.started_in_channel]
+        announce_channels.extend([ch for ch in config.Config.instance().get_giveaway_announce_channels() if ch != giveaway.started_in_channel])
+        await Cluster.instance().announce(announce_channels, embed)
         # DM the winner
         member = self.bot.get_user(winner.id)
+        if member is None:
+            member = await self.bot.fetch_user(winner.id)
         if member is not None:
             await Messages.send_success_dm(member, f"Congratulations! **You've won giveaway #{giveaway.id}**! I've sent you **{Env.raw_to_amount(tx_sum)} {Env.currency_symbol()}**")
-        # Cleanup
-        try:
-            self.giveaway_ids.remove(giveaway.id)
-        except ValueError:
-            pass
 
     @commands.command(aliases=START_GIVEAWAY_INFO.triggers)
     async def giveaway_cmd(self, ctx: Context):
@@ -377,8 +387,8 @@ class GiveawayCog(commands.Cog):
                                 await channel.send(embed=embed)
                             except Exception:
                                 pass
-                # Start the timer
-                asyncio.create_task(self.start_giveaway_timer(gw))
+                # Schedule its end
+                await self.schedule_giveaway(gw)
         except LockTimeoutError:
             await Messages.add_x_reaction(msg)
             await Messages.send_error_dm(msg.author, "I couldn't start a giveaway, maybe someone else beat you to it as there can only be 1 active at a time.")
@@ -448,13 +458,10 @@ class GiveawayCog(commands.Cog):
 
         # Check roles
         if is_private:
-            guild = self.bot.get_guild(gw.server_id)
-            if guild is None:
-                await Messages.send_error_dm(msg.author, "Something went wrong, ask my master for help")
-                return
-            member = guild.get_member(msg.author.id)
+            # The giveaway's guild may be on a shard run by another process
+            member = await Cluster.instance().get_member(gw.server_id, msg.author.id)
             if member is None:
-                await "You're not a member of that server"
+                await Messages.send_error_dm(msg.author, "You're not a member of that server")
                 return
             msg.author = member
     
@@ -769,8 +776,10 @@ class GiveawayCog(commands.Cog):
             if user_tx is not None:
                 if int(user_tx.amount) >= int(gw.entry_fee):
                     already_entered=True
-                user_tx.amount = str(int(user_tx.amount) + Env.amount_to_raw(tip_amount))
-                await user_tx.save(update_fields=['amount'], using_db=conn)
+                user_tx.amount_raw = int(user_tx.amount) + Env.amount_to_raw(tip_amount)
+                user_tx.amount = str(user_tx.amount_raw)
+                await user_tx.save(update_fields=['amount', 'amount_raw'], using_db=conn)
+                await User.update_pending(conn, pending_send={user.id: Env.amount_to_raw(tip_amount)})
             else:
                 user_tx = await Transaction.create_transaction_giveaway(
                     user,
@@ -810,8 +819,8 @@ class GiveawayCog(commands.Cog):
                                     await channel.send(embed=embed)
                                 except Exception:
                                     pass
-                    # Start the timer
-                    asyncio.create_task(self.start_giveaway_timer(gw))                    
+                    # Schedule its end
+                    await self.schedule_giveaway(gw)
         else:
             if not already_entered and int(user_tx.amount) >= int(gw.entry_fee):
                 await Messages.send_success_dm(msg.author, f"With your generous donation of {tip_amount} {Env.currency_symbol()} I have entered you into giveaway #{gw.id}!")
@@ -837,15 +846,14 @@ class GiveawayCog(commands.Cog):
         author = msg.author
         content = msg.content
 
-        # If private, see what servers they are part of
-        guilds = None
+        # If private, see which servers with an active giveaway they are part of
+        gws = None
         if ChannelUtil.is_private(msg.channel):
-            guilds = []
-            for g in self.bot.guilds:
-                if g.get_member(msg.author.id) is not None:
-                    guilds.append(g)
-            if len(guilds) == 0:
-                return
+            gws = []
+            for gw in await Giveaway.get_active_giveaways():
+                # Also finds servers on shards run by other processes
+                if await Cluster.instance().get_member(gw.server_id, msg.author.id) is not None:
+                    gws.append(gw)
 
         # See if they've been spamming
         redis_key = f"ticketspam:{msg.author.id}"
@@ -863,7 +871,7 @@ class GiveawayCog(commands.Cog):
             spam = 0
 
         # Get active giveaway(s) - public channel
-        if guilds == None:
+        if gws is None:
             gw = await Giveaway.get_active_giveaway(server_id=msg.guild.id)
 
             if gw is None:
@@ -902,9 +910,8 @@ class GiveawayCog(commands.Cog):
             await msg.author.send(embed=embed)
             await Messages.delete_message(msg)
             return
-        # Get active giveaways (private channel)
-        gws = await Giveaway.get_active_giveaways(server_ids=[g.id for g in guilds])
-        if gws is None or len(gws) == 0:
+        # Active giveaways (private channel)
+        if len(gws) == 0:
             await Messages.send_error_dm(msg.author, "There aren't any active giveaways.")
             await Messages.delete_message(msg)
             # Block ticket spam
@@ -1,6 +1,7 @@
 from cogs import tips, account, stats, rain, admin, useroptions, favorites, giveaway
 from discord.ext import commands
 from discord.ext.commands import Bot, Context
+from tasks.cluster import Cluster
 from util.env import Env
 from util.discord.messages import Messages
 from util.discord.paginator import Paginator, Page, CannotPaginate, Entry
@@ -83,7 +84,10 @@ ADMIN_COMMANDS = {
             admin.STATSUNBAN_INFO,
             admin.STATSBANNED_INFO,
             admin.DECREASETIPS_INFO,
-            admin.INCREASETIPS_INFO
+            admin.INCREASETIPS_INFO,
+            admin.DEADLETTERS_INFO,
+            admin.REPLAY_INFO,
+            admin.NODESTATS_INFO
         ]
     }
 }
@@ -110,6 +114,9 @@ class HelpCog(commands.Cog):
                             break
                 if ctx.admin:
                     break
+            if not ctx.admin:
+                # Their guild may be on a shard run by another process
+                ctx.admin = await Cluster.instance().is_role_admin(msg.author.id)
         else:
             ctx.admin = True
 
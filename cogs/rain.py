@@ -8,8 +8,6 @@ from util.env import Env
 
 import asyncio
 import config
-import datetime
-import rapidjson as json
 import logging
 from util.regex import AmountAmbiguousException, AmountMissingException, RegexUtil
 from util.validators import Validators
@@ -21,6 +19,7 @@ from db.redis import RedisDB
 from typing import List
 from models.constants import Constants
 from db.models.transaction import Transaction
+from tasks.activity_buffer import ActivityBuffer
 from tasks.transaction_queue import TransactionQueue
 
 # Commands Documentation
@@ -160,16 +159,15 @@ class RainCog(commands.Cog):
             return
 
         # Make the transactions in the database
-        tx_list = []
+        tx_list = await Transaction.create_transactions_internal_dbuser(
+            sending_user=user,
+            amount=individual_send_amount,
+            receiving_users=active_users
+        )
+        muted_by_ids = await user.get_muted_by_ids()
         task_list = []
         for u in active_users:
-            tx = await Transaction.create_transaction_internal_dbuser(
-                sending_user=user,
-                amount=individual_send_amount,
-                receiving_user=u
-            )
-            tx_list.append(tx)
-            if not await user.is_muted_by(u.id):
+            if u.id not in muted_by_ids:
                 if not anon:
                     task_list.append(
                         Messages.send_basic_dm(
@@ -191,8 +189,7 @@ class RainCog(commands.Cog):
         # Add reactions
         await Messages.add_tip_reaction(msg, amount_needed, rain=True)
         # Queue the actual sends
-        for tx in tx_list:
-            await TransactionQueue.instance().put(tx)
+        await TransactionQueue.instance().put_all(tx_list)
         # Add anti-spam
         await RedisDB.instance().set(f"rainspam{msg.author.id}", "as", expires=300)
         # Update stats
@@ -217,24 +214,8 @@ class RainCog(commands.Cog):
             if not has_rain_role:
                 return
 
-        # Get user OBJ from redis if it exists, else create one
-        user_key = f"activity:{msg.guild.id}:{msg.author.id}"
-        active_stats = await RedisDB.instance().get(user_key)
-        if active_stats is None:
-            # Create stats and save
-            active_stats = {
-                'user_id': msg.author.id,
-                'last_msg': datetime.datetime.now(datetime.timezone.utc).strftime('%m/%d/%Y %H:%M:%S'),
-                'msg_count': Constants.RAIN_MSG_REQUIREMENT * 2
-            }
-            await RedisDB.instance().set(user_key, json.dumps(active_stats), expires=1800)
-            return
-        else:
-            active_stats = json.loads(active_stats)
-            if active_stats['msg_count'] < Constants.RAIN_MSG_REQUIREMENT * 2:
-                active_stats['msg_count'] = Constants.RAIN_MSG_REQUIREMENT * 2
-            active_stats['last_msg'] = datetime.datetime.now(datetime.timezone.utc).strftime('%m/%d/%Y %H:%M:%S')
-            await RedisDB.instance().set(user_key, json.dumps(active_stats), expires=1800)
+        # Bump them up to rain eligible if they aren't already
+        await RedisDB.instance().set_activity_minimum(msg.guild.id, msg.author.id, Constants.RAIN_MSG_REQUIREMENT * 2)
 
     @staticmethod
     async def update_activity_stats(msg: discord.Message):
@@ -258,67 +239,19 @@ class RainCog(commands.Cog):
         if len(content_adjusted) == 0:
             return
 
-        # Get user OBJ from redis if it exists, else create one
-        user_key = f"activity:{msg.guild.id}:{msg.author.id}"
-        active_stats = await RedisDB.instance().get(user_key)
-        if active_stats is None:
-            # Create stats and save
-            active_stats = {
-                'user_id': msg.author.id,
-                'last_msg': datetime.datetime.now(datetime.timezone.utc).strftime('%m/%d/%Y %H:%M:%S'),
-                'msg_count': 1
-            }
-            await RedisDB.instance().set(user_key, json.dumps(active_stats), expires=1800)
-            return
-        else:
-            active_stats = json.loads(active_stats)
-
-        # Ignore em if they've messaged too recently
-        last_msg_dt = datetime.datetime.strptime(active_stats['last_msg'], '%m/%d/%Y %H:%M:%S')
-        last_msg_dt = last_msg_dt.replace(tzinfo=datetime.timezone.utc)
-        delta_s = (datetime.datetime.now(datetime.timezone.utc) - last_msg_dt).total_seconds()
-        if 90 > delta_s:
-            return
-        elif delta_s > 1200:
-            # Deduct a point
-            if active_stats['msg_count'] > 1:
-                active_stats['msg_count'] -= 1
-            active_stats['last_msg'] = datetime.datetime.now(datetime.timezone.utc).strftime('%m/%d/%Y %H:%M:%S')
-            await RedisDB.instance().set(user_key, json.dumps(active_stats), expires=1800)
-        else:
-            # add a point
-            if active_stats['msg_count'] <= Constants.RAIN_MSG_REQUIREMENT * 2:
-                active_stats['msg_count'] += 1
-                active_stats['last_msg'] = datetime.datetime.now(datetime.timezone.utc).strftime('%m/%d/%Y %H:%M:%S')
-                await RedisDB.instance().set(user_key, json.dumps(active_stats), expires=1800)
-            else:
-                # Reset key expiry
-                active_stats['last_msg'] = datetime.datetime.now(datetime.timezone.utc).strftime('%m/%d/%Y %H:%M:%S')
-                await RedisDB.instance().set(user_key, json.dumps(active_stats), expires=1800)
+        # Buffer this message, it's counted on the next flush
+        ActivityBuffer.instance().add(msg.guild.id, msg.author.id)
 
     @staticmethod
     async def get_active(ctx: Context, excluding: int = 0) -> List[User]:
         """Return a list of active users"""
         msg = ctx.message
-        redis = await RedisDB.instance().get_redis()
 
-        # Get all activity stats from DB
-        users_list = []
-        async for key in redis.iscan(match=f"*activity:{msg.guild.id}*"):
-            u = await redis.get(key)
-            if u is not None:
-                users_list.append(json.loads(u))
-
-        if len(users_list) == 0:
-            return []
+        # Make sure buffered activity for this guild is counted
+        await ActivityBuffer.instance().flush(msg.guild.id)
 
         # Get IDs that meet requirements
-        users_filtered = []
-        for u in users_list:
-            if u['user_id'] == excluding:
-                continue
-            elif u['msg_count'] >= Constants.RAIN_MSG_REQUIREMENT:
-                users_filtered.append(u['user_id'])
+        users_filtered = [u for u in await RedisDB.instance().get_active_user_ids(msg.guild.id, Constants.RAIN_MSG_REQUIREMENT) if u != excluding]
 
         if len(users_filtered) < 1:
             return []
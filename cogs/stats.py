@@ -1,6 +1,7 @@
 import datetime
 
 import discord
+from decimal import Decimal
 from discord.ext import commands
 from discord.ext.commands import Bot, Context
 from tortoise.functions import Sum
@@ -123,43 +124,24 @@ class StatsCog(commands.Cog):
             await Messages.add_timer_reaction(msg)
             return
 
-        # This would be better to be 1 query but, i'm not proficient enough with tortoise-orm
-        top_tip = await Stats.filter(
-            server_id=msg.guild.id,
-            banned=False
-        ).order_by('-top_tip').prefetch_related('user').limit(1).first()
-        if top_tip is None:
+        top_tips = await Stats.get_top_tips(msg.guild.id)
+        if 'all' not in top_tips:
             await RedisDB.instance().set(f"toptipsspam{msg.channel.id}", "as", expires=300)
             await msg.channel.send("There are no stats for this server yet. Send some tips first!")
             return
-        # Get datetime object representing first day of this month
         now = datetime.datetime.now(datetime.timezone.utc)
-        month = str(now.month).zfill(2)
-        year = now.year
-        first_day_of_month = datetime.datetime.strptime(f'{month}/01/{year} 00:00:00', '%m/%d/%Y %H:%M:%S')
-        # Find top tip of the month
-        top_tip_month = await Stats.filter(
-            server_id=msg.guild.id,
-            top_tip_month_at__gte=first_day_of_month,
-            banned=False
-        ).order_by('-top_tip_month').prefetch_related('user').limit(1).first()
-        # Get datetime object representing 24 hours ago
-        past_24h = now - datetime.timedelta(hours=24)
-        # Find top tip of the month
-        top_tip_day = await Stats.filter(
-            server_id=msg.guild.id,
-            top_tip_day_at__gte=past_24h,
-            banned=False
-        ).order_by('-top_tip_day').prefetch_related('user').limit(1).first()
+        top_tip = top_tips['all']
+        top_tip_month = top_tips.get('month', None)
+        top_tip_day = top_tips.get('day', None)
 
         embed = discord.Embed(colour=0xFBDD11 if Env.banano() else discord.Colour.dark_blue())
         embed.set_author(name='Biggest Tips', icon_url="https://github.com/bbedward/graham_discord_bot/raw/master/assets/banano_logo.png" if Env.banano() else "https://github.com/bbedward/graham_discord_bot/raw/master/assets/nano_logo.png")
         new_line = '\n' # Can't use this directly inside f-expression, so store it in a variable
         if top_tip_day is not None:
-            embed.description = f"**Last 24 Hours**\n```{Env.format_float(top_tip_day.top_tip_day)} {Env.currency_symbol()} - by {top_tip_day.user.name}```"
+            embed.description = f"**Last 24 Hours**\n```{Env.format_float(Decimal(top_tip_day['amount']))} {Env.currency_symbol()} - by {top_tip_day['name']}```"
         if top_tip_month is not None:
-            embed.description += f"{new_line if top_tip_day is not None else ''}**In {now.strftime('%B')}**\n```{Env.format_float(top_tip_month.top_tip_month)} {Env.currency_symbol()} - by {top_tip_month.user.name}```"
-        embed.description += f"{new_line if top_tip_day is not None or top_tip_month is not None else ''}**All Time**\n```{Env.format_float(top_tip.top_tip)} {Env.currency_symbol()} - by {top_tip.user.name}```"
+            embed.description += f"{new_line if top_tip_day is not None else ''}**In {now.strftime('%B')}**\n```{Env.format_float(Decimal(top_tip_month['amount']))} {Env.currency_symbol()} - by {top_tip_month['name']}```"
+        embed.description += f"{new_line if top_tip_day is not None or top_tip_month is not None else ''}**All Time**\n```{Env.format_float(Decimal(top_tip['amount']))} {Env.currency_symbol()} - by {top_tip['name']}```"
 
         # No spam
         await RedisDB.instance().set(f"toptipsspam{msg.channel.id}", "as", expires=300)
@@ -180,7 +162,7 @@ class StatsCog(commands.Cog):
             return
 
         # Get list
-        ballers = await Stats.filter(server_id=msg.guild.id, banned=False).order_by('-total_tipped_amount').prefetch_related('user').limit(15).all()
+        ballers = await Stats.get_leaderboard(msg.guild.id)
 
         if len(ballers) == 0:
             await msg.channel.send(f"<@{msg.author.id}> There are no stats for this server yet, send some tips!")
@@ -222,7 +204,7 @@ class StatsCog(commands.Cog):
             return
 
         # Get list
-        ballers = await Stats.filter(server_id=msg.guild.id, banned=False).order_by('-legacy_total_tipped_amount').prefetch_related('user').limit(15).all()
+        ballers = await Stats.get_leaderboard(msg.guild.id, legacy=True)
 
         if len(ballers) == 0:
             await msg.channel.send(f"<@{msg.author.id}> There are no stats for this server yet, send some tips!")
@@ -177,24 +177,23 @@ class TipsCog(commands.Cog):
             return
 
         # Make the transactions in the database
-        tx_list = []
+        tx_list = await Transaction.create_transactions_internal(
+            sending_user=user,
+            amount=send_amount,
+            receiving_users=users_to_tip
+        )
+        tipped_ids = [tx.receiving_user_id for tx in tx_list]
+        muted_by_ids = await user.get_muted_by_ids()
         task_list = []
         for u in users_to_tip:
-            tx = await Transaction.create_transaction_internal(
-                sending_user=user,
-                amount=send_amount,
-                receiving_user=u
-            )
-            if tx is not None:
-                tx_list.append(tx)
-                if not await user.is_muted_by(u.id):
-                    task_list.append(
-                        Messages.send_basic_dm(
-                            member=u,
-                            message=f"You were tipped **{send_amount} {Env.currency_symbol()}** by {msg.author.name.replace('`', '')}.\nUse `{config.Config.instance().command_prefix}mute {msg.author.id}` to disable notifications for this user.",
-                            skip_dnd=True
-                        )
+            if u.id in tipped_ids and u.id not in muted_by_ids:
+                task_list.append(
+                    Messages.send_basic_dm(
+                        member=u,
+                        message=f"You were tipped **{send_amount} {Env.currency_symbol()}** by {msg.author.name.replace('`', '')}.\nUse `{config.Config.instance().command_prefix}mute {msg.author.id}` to disable notifications for this user.",
+                        skip_dnd=True
                     )
+                )
         if len(tx_list) < 1:
             await Messages.add_x_reaction(msg)
             await Messages.send_error_dm(msg.author, f"No users you mentioned are eligible to receive tips.")
@@ -204,8 +203,7 @@ class TipsCog(commands.Cog):
         # Add reactions
         await Messages.add_tip_reaction(msg, send_amount * len(tx_list))
         # Queue the actual sends
-        for tx in tx_list:
-            await TransactionQueue.instance().put(tx)
+        await TransactionQueue.instance().put_all(tx_list)
         # Update stats
         stats: Stats = await user.get_stats(server_id=msg.guild.id)
         if msg.channel.id not in config.Config.instance().get_no_stats_channels():
@@ -246,24 +244,23 @@ class TipsCog(commands.Cog):
             return
 
         # Make the transactions in the database
-        tx_list = []
+        tx_list = await Transaction.create_transactions_internal(
+            sending_user=user,
+            amount=individual_send_amount,
+            receiving_users=users_to_tip
+        )
+        tipped_ids = [tx.receiving_user_id for tx in tx_list]
+        muted_by_ids = await user.get_muted_by_ids()
         task_list = []
         for u in users_to_tip:
-            tx = await Transaction.create_transaction_internal(
-                sending_user=user,
-                amount=individual_send_amount,
-                receiving_user=u
-            )
-            if tx is not None:
-                tx_list.append(tx)
-                if not await user.is_muted_by(u.id):
-                    task_list.append(
-                        Messages.send_basic_dm(
-                            member=u,
-                            message=f"You were tipped **{individual_send_amount} {Env.currency_symbol()}** by {msg.author.name.replace('`', '')}.\nUse `{config.Config.instance().command_prefix}mute {msg.author.id}` to disable notifications for this user.",
-                            skip_dnd=True
-                        )
+            if u.id in tipped_ids and u.id not in muted_by_ids:
+                task_list.append(
+                    Messages.send_basic_dm(
+                        member=u,
+                        message=f"You were tipped **{individual_send_amount} {Env.currency_symbol()}** by {msg.author.name.replace('`', '')}.\nUse `{config.Config.instance().command_prefix}mute {msg.author.id}` to disable notifications for this user.",
+                        skip_dnd=True
                     )
+                )
         if len(tx_list) < 1:
             await Messages.add_x_reaction(msg)
             await Messages.send_error_dm(msg.author, f"No users you mentioned are eligible to receive tips.")
@@ -273,8 +270,7 @@ class TipsCog(commands.Cog):
         # Add reactions
         await Messages.add_tip_reaction(msg, amount_needed)
         # Queue the actual sends
-        for tx in tx_list:
-            await TransactionQueue.instance().put(tx)
+        await TransactionQueue.instance().put_all(tx_list)
         # Update stats
         stats: Stats = await user.get_stats(server_id=msg.guild.id)
         if msg.channel.id not in config.Config.instance().get_no_stats_channels():
@@ -50,6 +50,9 @@ class Config(object):
             if cls.wallet is  None:
                 print("WALLET_ID must be specified in your environment")
                 exit(1)
+            if os.getenv('SHARD_IDS') is not None and os.getenv('SHARD_COUNT') is None:
+                print("SHARD_COUNT must be set in your environment when SHARD_IDS is")
+                exit(1)
 
             cls.node_url = options.node_url
         return cls._instance
@@ -196,4 +199,162 @@ class Config(object):
             return default
         elif 'restrictions' in self.yaml and 'no_stats_channels' in self.yaml['restrictions']:
             return self.yaml['restrictions']['no_stats_channels']
-        return default
\ No newline at end of file
+        return default
+
+    def get_transaction_queue_workers(self) -> int:
+        """Number of concurrent transaction queue consumers"""
+        default = 4
+        if not self.has_yaml():
+            return default
+        elif 'transactions' in self.yaml and 'workers' in self.yaml['transactions']:
+            return int(self.yaml['transactions']['workers'])
+        return default
+
+    def get_activity_flush_interval(self) -> int:
+        """Seconds between writes of buffered chat activity, must stay below the 90s activity cooldown"""
+        default = 5
+        if not self.has_yaml():
+            return default
+        elif 'restrictions' in self.yaml and 'activity_flush_interval' in self.yaml['restrictions']:
+            return max(1, min(60, int(self.yaml['restrictions']['activity_flush_interval'])))
+        return default
+
+    def get_balance_cache_ttl(self) -> int:
+        """Seconds an account balance from the node is reused for, 0 disables the cache"""
+        default = 10
+        if not self.has_yaml():
+            return default
+        elif 'balance_cache' in self.yaml and 'ttl' in self.yaml['balance_cache']:
+            return int(self.yaml['balance_cache']['ttl'])
+        return default
+
+    def get_balance_cache_redis(self) -> bool:
+        """Whether cached balances are shared between processes through redis"""
+        default = False
+        if not self.has_yaml():
+            return default
+        elif 'balance_cache' in self.yaml and 'redis' in self.yaml['balance_cache']:
+            return bool(self.yaml['balance_cache']['redis'])
+        return default
+
+    def get_dm_concurrency(self) -> int:
+        """Number of DMs being delivered at the same time"""
+        default = 4
+        if not self.has_yaml():
+            return default
+        elif 'notifications' in self.yaml and 'concurrency' in self.yaml['notifications']:
+            return int(self.yaml['notifications']['concurrency'])
+        return default
+
+    def get_dm_rate(self) -> float:
+        """Most DMs sent per second"""
+        default = 4
+        if not self.has_yaml():
+            return default
+        elif 'notifications' in self.yaml and 'rate' in self.yaml['notifications']:
+            return float(self.yaml['notifications']['rate'])
+        return default
+
+    def get_account_pool_size(self) -> int:
+        """Number of wallet accounts created ahead of time for new users, 0 disables the pool"""
+        default = 25
+        if not self.has_yaml():
+            return default
+        elif 'account_pool' in self.yaml and 'size' in self.yaml['account_pool']:
+            return int(self.yaml['account_pool']['size'])
+        return default
+
+    def get_receive_interval(self) -> int:
+        """Seconds between scans for pending blocks on bot accounts, 0 disables the background receiver"""
+        default = 60
+        if not self.has_yaml():
+            return default
+        elif 'receive' in self.yaml and 'interval' in self.yaml['receive']:
+            return int(self.yaml['receive']['interval'])
+        return default
+
+    def get_receive_threshold(self) -> int:
+        """Smallest pending block (in RAW) the bot receives, smaller ones aren't worth the work"""
+        default = 10**27
+        if not self.has_yaml():
+            return default
+        elif 'receive' in self.yaml and 'threshold' in self.yaml['receive']:
+            return int(self.yaml['receive']['threshold'])
+        return default
+
+    def get_receive_concurrency(self) -> int:
+        """Number of accounts receiving pending blocks at the same time"""
+        default = 4
+        if not self.has_yaml():
+            return default
+        elif 'receive' in self.yaml and 'concurrency' in self.yaml['receive']:
+            return int(self.yaml['receive']['concurrency'])
+        return default
+
+    def get_node_urls(self) -> List[str]:
+        """Node RPC URLs, the first one holds the wallet. Others only serve lookups"""
+        default = [self.node_url]
+        if not self.has_yaml():
+            return default
+        elif 'rpc' in self.yaml and 'urls' in self.yaml['rpc']:
+            return self.yaml['rpc']['urls']
+        return default
+
+    def get_rpc_connection_limit(self) -> int:
+        """Most open connections to each node"""
+        default = 100
+        if not self.has_yaml():
+            return default
+        elif 'rpc' in self.yaml and 'connections' in self.yaml['rpc']:
+            return int(self.yaml['rpc']['connections'])
+        return default
+
+    def get_rpc_keepalive(self) -> int:
+        """Seconds idle connections to a node are kept open"""
+        default = 30
+        if not self.has_yaml():
+            return default
+        elif 'rpc' in self.yaml and 'keepalive' in self.yaml['rpc']:
+            return int(self.yaml['rpc']['keepalive'])
+        return default
+
+    def get_rpc_dns_cache(self) -> int:
+        """Seconds resolved node hostnames are cached"""
+        default = 300
+        if not self.has_yaml():
+            return default
+        elif 'rpc' in self.yaml and 'dns_cache' in self.yaml['rpc']:
+            return int(self.yaml['rpc']['dns_cache'])
+        return default
+
+    def get_rpc_timeouts(self) -> dict:
+        """Seconds to wait for the node per kind of action"""
+        timeouts = {
+            'wallet': 120,
+            'create': 60,
+            'read': 10
+        }
+        if self.has_yaml() and 'rpc' in self.yaml and 'timeouts' in self.yaml['rpc']:
+            timeouts.update(self.yaml['rpc']['timeouts'])
+        return timeouts
+
+    def get_shard_count(self) -> int:
+        """Total number of shards across all bot processes, None lets discord decide"""
+        shard_count = os.getenv('SHARD_COUNT', None)
+        return int(shard_count) if shard_count is not None else None
+
+    def get_shard_ids(self) -> List[int]:
+        """Shards run by this process, None runs all of them.
+            Taken from SHARD_IDS, or from the ordinal at the end of a StatefulSet pod's hostname"""
+        shard_ids = os.getenv('SHARD_IDS', None)
+        if shard_ids is not None:
+            return [int(s) for s in shard_ids.split(',')]
+        shard_count = self.get_shard_count()
+        if shard_count is None:
+            return None
+        hostname = os.getenv('HOSTNAME', '')
+        if '-' not in hostname or not hostname.rsplit('-', 1)[1].isdigit():
+            return None
+        ordinal = int(hostname.rsplit('-', 1)[1])
+        per_process = int(os.getenv('SHARDS_PER_PROCESS', 1))
+        return [s for s in range(ordinal * per_process, (ordinal + 1) * per_process) if s < shard_count]
\ No newline at end of file
@@ -0,0 +1,22 @@
+from decimal import Decimal
+from tortoise import fields
+
+class RawAmountField(fields.Field, int):
+    """Whole raw amount, stored as numeric(39,0) so the database can do arithmetic on it"""
+    SQL_TYPE = "NUMERIC(39,0)"
+
+    def to_db_value(self, value, instance):
+        if value is None:
+            return None
+        # Decimal(int) is exact no matter the precision of the decimal context
+        return Decimal(int(value))
+
+    def to_python_value(self, value):
+        if value is None:
+            return None
+        return int(value)
+
+    class _db_sqlite:
+        # SQLite numbers are 64-bit, keep the exact digits as text
+        # (tortoise's sqlite backend writes Decimal parameters as strings)
+        SQL_TYPE = "VARCHAR(40)"
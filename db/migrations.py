@@ -0,0 +1,76 @@
+import logging
+
+from tortoise.transactions import in_transaction
+
+import db.models.user as usr
+
+# New columns on existing tables, generate_schemas only creates missing tables
+# (table, column, postgres type, sqlite type, backfill run once after the column is added)
+# a backfill is either a statement per dialect or a coroutine function
+COLUMNS = [
+    (
+        'transactions', 'amount_raw',
+        "NUMERIC(39,0) NOT NULL DEFAULT 0",
+        "VARCHAR(40) NOT NULL DEFAULT '0'",
+        {
+            'postgres': "UPDATE transactions SET amount_raw = CAST(amount AS NUMERIC(39,0))",
+            'sqlite': "UPDATE transactions SET amount_raw = amount"
+        }
+    ),
+    ('users', 'pending_send_raw', "NUMERIC(39,0) NOT NULL DEFAULT 0", "VARCHAR(40) NOT NULL DEFAULT '0'", None),
+    ('users', 'pending_receive_raw', "NUMERIC(39,0) NOT NULL DEFAULT 0", "VARCHAR(40) NOT NULL DEFAULT '0'", usr.User.rebuild_pending),
+    ('transactions', 'lease_until', "TIMESTAMPTZ", "TIMESTAMP", None),
+    ('transactions', 'attempts', "INTEGER NOT NULL DEFAULT 0", "INTEGER NOT NULL DEFAULT 0", None),
+]
+
+# Postgres advisory lock held while migrating, processes starting together take turns
+MIGRATION_LOCK_ID = 7263301
+
+# (name, table, columns, where clause for partial indexes)
+INDEXES = [
+    ('transactions_pending_send_idx', 'transactions', 'sending_user_id', 'block_hash IS NULL'),
+    ('transactions_pending_receive_idx', 'transactions', 'receiving_user_id', 'block_hash IS NULL'),
+    ('transactions_lease_idx', 'transactions', 'lease_until', 'block_hash IS NULL'),
+    ('stats_ballers_idx', 'stats', 'server_id, banned, total_tipped_amount', None),
+    ('stats_legacyboard_idx', 'stats', 'server_id, banned, legacy_total_tipped_amount', None),
+    ('stats_top_tip_idx', 'stats', 'server_id, banned, top_tip', None),
+]
+
+async def column_exists(conn, dialect: str, table: str, column: str) -> bool:
+    if dialect == 'sqlite':
+        rows = await conn.execute_query_dict(f"PRAGMA table_info({table})")
+        return column in [r['name'] for r in rows]
+    rows = await conn.execute_query_dict(
+        "SELECT 1 FROM information_schema.columns WHERE table_name = $1 AND column_name = $2",
+        [table, column]
+    )
+    return len(rows) > 0
+
+async def run_migrations():
+    """Bring an existing database schema up to date with the models, safe to run on every startup
+        and from several processes at once"""
+    logger = logging.getLogger()
+    # One transaction, DDL included, so a failed migration leaves nothing half done
+    async with in_transaction() as conn:
+        dialect = conn.capabilities.dialect
+        if dialect == 'postgres':
+            # Whoever gets the lock first migrates, the others find nothing left to do once it's released
+            await conn.execute_query("SELECT pg_advisory_xact_lock($1)", [MIGRATION_LOCK_ID])
+        for table, column, pg_type, sqlite_type, backfill in COLUMNS:
+            if await column_exists(conn, dialect, table, column):
+                continue
+            logger.info(f"Adding column {table}.{column}")
+            if dialect == 'sqlite':
+                await conn.execute_script(f"ALTER TABLE {table} ADD COLUMN {column} {sqlite_type}")
+            else:
+                await conn.execute_script(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {pg_type}")
+            if callable(backfill):
+                # Runs in this transaction, it's the current connection
+                await backfill()
+            elif backfill is not None and dialect in backfill:
+                await conn.execute_script(backfill[dialect])
+        for name, table, columns, where in INDEXES:
+            sql = f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+            if where is not None:
+                sql += f" WHERE {where}"
+            await conn.execute_script(sql)
@@ -1,9 +1,52 @@
 from tortoise.models import Model
+from tortoise.transactions import in_transaction
 from tortoise import fields
 
+from rpc.client import RPCClient
+from typing import List
+
 class Account(Model):
     user = fields.OneToOneField('db.User', related_name='account', index=True)
     address = fields.CharField(max_length=65, unique=True, index=True)
 
     class Meta:
         table = 'accounts'
+
+    @staticmethod
+    async def create_address(conn) -> str:
+        """Get an address for a new account, from the pool if it has any left
+            a claim is undone if conn's transaction rolls back"""
+        address = await PooledAccount.claim(conn)
+        if address is not None:
+            return address
+        address = await RPCClient.instance().account_create()
+        if address is None:
+            raise Exception("RPC account create failed")
+        return address
+
+class PooledAccount(Model):
+    """Wallet accounts created ahead of time, handed out to new users"""
+    id = fields.IntField(pk=True)
+    address = fields.CharField(max_length=65, unique=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = 'account_pool'
+
+    @staticmethod
+    async def claim(conn, attempts: int = 5) -> str:
+        """Take an account out of the pool, None if it's empty"""
+        for _ in range(attempts):
+            pooled = await PooledAccount.all().using_db(conn).order_by('id').first()
+            if pooled is None:
+                return None
+            # Somebody else may have claimed it in the meantime
+            if await PooledAccount.filter(id=pooled.id).using_db(conn).delete() > 0:
+                return pooled.address
+        return None
+
+    @staticmethod
+    async def add(addresses: List[str]):
+        """Put new accounts in the pool"""
+        async with in_transaction() as conn:
+            await PooledAccount.bulk_create([PooledAccount(address=a) for a in addresses], using_db=conn)
@@ -3,6 +3,7 @@ from tortoise.transactions import in_transaction
 from tortoise import fields
 
 import db.models.user as usr
+from db.redis import RedisDB
 
 class Muted(Model):
     user = fields.ForeignKeyField('db.User', related_name='muted', index=True)
@@ -21,10 +22,12 @@ class Muted(Model):
             )
             async with in_transaction() as conn:
                 await m.save(using_db=conn)
+            await RedisDB.instance().delete(f"mutedby:{muted_target.id}")
         else:
             raise Exception("User is already muted")
 
     @staticmethod
     async def unmute_user(unmuted_by: usr.User, muted_target: usr.User):
         # TODO - Tortoise-ORM doesnt provide any feedback for deletes
-        await Muted.filter(user=unmuted_by, target_user=muted_target).delete()
\ No newline at end of file
+        await Muted.filter(user=unmuted_by, target_user=muted_target).delete()
+        await RedisDB.instance().delete(f"mutedby:{muted_target.id}")
\ No newline at end of file
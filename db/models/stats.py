@@ -1,4 +1,7 @@
 from db.redis import RedisDB
+from decimal import Decimal
+from typing import List
+from tortoise.expressions import F, Q
 from tortoise.models import Model
 from tortoise.transactions import in_transaction
 from tortoise import fields
@@ -7,6 +10,10 @@ from util.env import Env
 import asyncio
 import datetime
 import logging
+import rapidjson as json
+
+# How long biggest tips are cached, the 24 hour window is at most this far behind
+TOPTIPS_CACHE_EXPIRY = 300
 
 class Stats(Model):
     user = fields.ForeignKeyField('db.User', related_name='stats', unique=True, index=True) 
@@ -30,64 +37,108 @@ class Stats(Model):
     class Meta:
         unique_together = ('user', 'server_id')
 
-    async def update_tip_stats(self, amount: float, giveaway: bool = False, rain: bool = False):
-        # TODO - would be better to do these updates atomically
-        # https://github.com/tortoise/tortoise-orm/issues/245
+    @staticmethod
+    async def get_leaderboard(server_id: int, legacy: bool = False, count: int = 15) -> List['Stats']:
+        """Top tippers of a server, ranked by the leaderboard cached in redis
+            a missing leaderboard is rebuilt from the database"""
+        board = 'legacyboard' if legacy else 'ballers'
+        field = 'legacy_total_tipped_amount' if legacy else 'total_tipped_amount'
+        user_ids = await RedisDB.instance().leaderboard_get(board, server_id, count)
+        if user_ids is None:
+            scores = await Stats.filter(server_id=server_id, banned=False).values_list('user_id', field)
+            await RedisDB.instance().leaderboard_set(board, server_id, {user_id: float(amount) for user_id, amount in scores})
+            user_ids = [user_id for user_id, amount in sorted(scores, key=lambda s: s[1], reverse=True)[:count]]
+        if len(user_ids) == 0:
+            return []
+        ballers = await Stats.filter(server_id=server_id, user_id__in=user_ids, banned=False).prefetch_related('user').all()
+        return sorted(ballers, key=lambda s: getattr(s, field), reverse=True)
+
+    @staticmethod
+    async def get_top_tips(server_id: int) -> dict:
+        """Biggest tips of a server of all time, this month and in the last 24 hours
+            returns a dict of period: {'amount', 'name'}, periods without tips are missing"""
+        cached = await RedisDB.instance().get(f"toptips:{server_id}")
+        if cached is not None:
+            return json.loads(cached)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        start_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        past_24h = now - datetime.timedelta(hours=24)
+        top_tips = {}
+        top_tip = await Stats.filter(
+            server_id=server_id,
+            banned=False
+        ).order_by('-top_tip').prefetch_related('user').first()
+        if top_tip is not None:
+            top_tips['all'] = {'amount': str(top_tip.top_tip), 'name': top_tip.user.name}
+        top_tip_month = await Stats.filter(
+            server_id=server_id,
+            top_tip_month_at__gte=start_of_month,
+            banned=False
+        ).order_by('-top_tip_month').prefetch_related('user').first()
+        if top_tip_month is not None:
+            top_tips['month'] = {'amount': str(top_tip_month.top_tip_month), 'name': top_tip_month.user.name}
+        top_tip_day = await Stats.filter(
+            server_id=server_id,
+            top_tip_day_at__gte=past_24h,
+            banned=False
+        ).order_by('-top_tip_day').prefetch_related('user').first()
+        if top_tip_day is not None:
+            top_tips['day'] = {'amount': str(top_tip_day.top_tip_day), 'name': top_tip_day.user.name}
+        await RedisDB.instance().set(f"toptips:{server_id}", json.dumps(top_tips), expires=TOPTIPS_CACHE_EXPIRY)
+        return top_tips
+
+    @staticmethod
+    async def invalidate_leaderboards(server_id: int = None):
+        """Drop cached leaderboards and biggest tips of a server, or of every server"""
+        await RedisDB.instance().leaderboard_clear(server_id)
+        if server_id is not None:
+            await RedisDB.instance().delete(f"toptips:{server_id}")
 
-        # Reset ballers list if it's a new year
-        if self.stats_reset_at.year < datetime.datetime.now(datetime.timezone.utc).year:
-            await Stats.all().update(total_tipped_amount=0, stats_reset_at=datetime.datetime.now(datetime.timezone.utc))
+    @staticmethod
+    async def reset_yearly():
+        """Reset the yearly tipped amount of everybody that wasn't reset this year yet"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        start_of_year = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        async with in_transaction() as conn:
+            reset_count = await Stats.filter(stats_reset_at__lt=start_of_year).using_db(conn).update(total_tipped_amount=0, stats_reset_at=now)
+        if reset_count > 0:
+            await RedisDB.instance().leaderboard_clear()
+        return reset_count
+
+    async def update_tip_stats(self, amount: float, giveaway: bool = False, rain: bool = False):
+        """Count a tip towards these stats, every change is a single conditional UPDATE so concurrent tips can't overwrite each other"""
+        amount = Decimal(str(Env.truncate_digits(amount, max_digits=Env.precision_digits())))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        start_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        past_24h = now - datetime.timedelta(hours=24)
 
-        # Update total tipped amount and count
-        amount = Env.truncate_digits(amount, max_digits=Env.precision_digits())
-        self.total_tipped_amount = Env.truncate_digits(float(self.total_tipped_amount) + amount, max_digits=Env.precision_digits())
-        self.legacy_total_tipped_amount = Env.truncate_digits(float(self.legacy_total_tipped_amount) + amount, max_digits=Env.precision_digits())
-        self.total_tips += 1
-        # Update all time tip if necessary
-        top_tip_updated = False
-        if amount > self.top_tip:
-            self.top_tip = amount
-            self.top_tip_at = datetime.datetime.now(datetime.timezone.utc)
-            top_tip_updated = True
-        # Update monthly tip if necessary
-        top_tip_month_updated = False
-        if self.top_tip_month_at.month != datetime.datetime.now(datetime.timezone.utc).month or amount > self.top_tip_month:
-            self.top_tip_month = amount
-            self.top_tip_month_at = datetime.datetime.now(datetime.timezone.utc)
-            top_tip_month_updated = True
-        # Update 24H tip if necessary
-        top_tip_day_updated = False
-        delta = datetime.datetime.now(datetime.timezone.utc) - self.top_tip_day_at
-        if delta.total_seconds() > 86400 or amount > self.top_tip_day:
-            self.top_tip_day = amount
-            self.top_tip_day_at = datetime.datetime.now(datetime.timezone.utc)
-            top_tip_day_updated = True
-        # Update rain or giveaway stats
-        rain_updated = False
-        giveaway_updated = False
+        totals = {
+            'total_tipped_amount': F('total_tipped_amount') + amount,
+            'legacy_total_tipped_amount': F('legacy_total_tipped_amount') + amount,
+            'total_tips': F('total_tips') + 1
+        }
         if rain:
-            self.rain_amount = Env.truncate_digits(float(self.rain_amount) + amount, max_digits=Env.precision_digits())
-            rain_updated = True
+            totals['rain_amount'] = F('rain_amount') + amount
         elif giveaway:
-            self.giveaway_amount = Env.truncate_digits(float(self.giveaway_amount) + amount, max_digits=Env.precision_digits())
-            giveaway_updated = True
+            totals['giveaway_amount'] = F('giveaway_amount') + amount
 
         async with in_transaction() as conn:
-            update_fields = ['total_tipped_amount', 'legacy_total_tipped_amount', 'total_tips']
-            if top_tip_updated:
-                update_fields.append('top_tip')
-                update_fields.append('top_tip_at')
-            if top_tip_month_updated:
-                update_fields.append('top_tip_month')
-                update_fields.append('top_tip_month_at')
-            if top_tip_day_updated:
-                update_fields.append('top_tip_day')
-                update_fields.append('top_tip_day_at')
-            if rain_updated:
-                update_fields.append('rain_amount')
-            if giveaway_updated:
-                update_fields.append('giveaway_amount')
-            await self.save(
-                update_fields=update_fields,
-                using_db=conn
-            )
+            await Stats.filter(id=self.id).using_db(conn).update(**totals)
+            # Update all time tip if necessary
+            top_tips_updated = await Stats.filter(id=self.id, top_tip__lt=amount).using_db(conn).update(top_tip=amount, top_tip_at=now)
+            # Update monthly tip if necessary, the previous one expires with the month
+            top_tips_updated += await Stats.filter(
+                Q(top_tip_month__lt=amount) | Q(top_tip_month_at__lt=start_of_month),
+                id=self.id
+            ).using_db(conn).update(top_tip_month=amount, top_tip_month_at=now)
+            # Update 24H tip if necessary
+            top_tips_updated += await Stats.filter(
+                Q(top_tip_day__lt=amount) | Q(top_tip_day_at__lt=past_24h),
+                id=self.id
+            ).using_db(conn).update(top_tip_day=amount, top_tip_day_at=now)
+
+        # Keep cached leaderboards current
+        if not self.banned:
+            await RedisDB.instance().leaderboard_incr(self.server_id, self.user_id, float(amount))
+            if top_tips_updated > 0:
+                await RedisDB.instance().delete(f"toptips:{self.server_id}")
@@ -1,14 +1,25 @@
+import datetime
 import discord
 from tortoise import fields
 from tortoise.models import Model
+from tortoise.expressions import Q
+from tortoise.functions import Max, Sum
 from tortoise.transactions import in_transaction
 
 import db.models.giveaway as gway
 import db.models.user as usr
 
+from db.fields import RawAmountField
+from rpc.balance_cache import BalanceCache
 from rpc.client import RPCClient
+from typing import List, Tuple
 from util.env import Env
 
+# Seconds a claimed transaction is reserved for its consumer, longer than an RPC send can take
+LEASE_DURATION = 360
+# Failed sends after which a transaction is moved to the dead letters
+MAX_SEND_ATTEMPTS = 20
+
 
 class Transaction(Model):
     id = fields.UUIDField(pk=True)
@@ -17,10 +28,12 @@ class Transaction(Model):
     destination = fields.CharField(max_length=65, null=True)
     block_hash = fields.CharField(max_length=64, index=True, null=True)
     amount = fields.CharField(max_length=50)
+    amount_raw = RawAmountField(default=0)
     created_at = fields.DatetimeField(auto_now_add=True, index=True)
     modified_at = fields.DatetimeField(auto_now=True)
     giveaway = fields.ForeignKeyField('db.Giveaway', related_name='giveaway_transactions', null=True, index=True)
-    retries = 0
+    lease_until = fields.DatetimeField(null=True)
+    attempts = fields.IntField(default=0)
 
     class Meta:
         table = 'transactions'
@@ -41,10 +54,12 @@ class Transaction(Model):
             tx = Transaction(
                 sending_user = sending_user,
                 amount = str(Env.amount_to_raw(amount)),
+                amount_raw = Env.amount_to_raw(amount),
                 destination = await receiving_user_db.get_address(),
                 receiving_user = receiving_user_db
             )
             await tx.save(using_db=conn)
+            await Transaction.update_pending(conn, [tx])
         return tx
 
     @staticmethod
@@ -59,12 +74,51 @@ class Transaction(Model):
             tx = Transaction(
                 sending_user = sending_user,
                 amount = str(Env.amount_to_raw(amount)),
+                amount_raw = Env.amount_to_raw(amount),
                 destination = await receiving_user.get_address(),
                 receiving_user = receiving_user
             )
             await tx.save(using_db=conn)
+            await Transaction.update_pending(conn, [tx])
         return tx
 
+    @staticmethod
+    async def create_transactions_internal(
+                                sending_user: usr.User,
+                                amount: float,
+                                receiving_users: List[discord.User]) -> List['Transaction']:
+        """Create transactions in the database for multiple discord users at once,
+           tip banned users are skipped"""
+        receiving_users_db = await usr.User.create_or_fetch_users(receiving_users)
+        return await Transaction.create_transactions_internal_dbuser(
+            sending_user=sending_user,
+            amount=amount,
+            receiving_users=[u for u in receiving_users_db if not u.tip_banned]
+        )
+
+    @staticmethod
+    async def create_transactions_internal_dbuser(
+                                sending_user: usr.User,
+                                amount: float,
+                                receiving_users: List[usr.User]) -> List['Transaction']:
+        """Create transactions in the database for multiple users at once,
+           all rows are written in one database transaction with a single insert"""
+        raw_amount = Env.amount_to_raw(amount)
+        tx_list = []
+        for receiving_user in receiving_users:
+            tx_list.append(Transaction(
+                sending_user = sending_user,
+                amount = str(raw_amount),
+                amount_raw = raw_amount,
+                destination = await receiving_user.get_address(),
+                receiving_user = receiving_user
+            ))
+        if len(tx_list) > 0:
+            async with in_transaction() as conn:
+                await Transaction.bulk_create(tx_list, using_db=conn)
+                await Transaction.update_pending(conn, tx_list)
+        return tx_list
+
     @staticmethod
     async def create_transaction_external(
                                 sending_user: usr.User,
@@ -77,10 +131,12 @@ class Transaction(Model):
             tx = Transaction(
                 sending_user = sending_user,
                 amount = raw_amt if raw_amt else str(Env.amount_to_raw(amount)),
+                amount_raw = int(raw_amt) if raw_amt else Env.amount_to_raw(amount),
                 destination = destination,
                 receiving_user = None
             )
             await tx.save(using_db=conn)
+            await Transaction.update_pending(conn, [tx])
         return tx
 
     @staticmethod
@@ -95,11 +151,160 @@ class Transaction(Model):
         tx = Transaction(
             sending_user = sending_user,
             amount = str(Env.amount_to_raw(amount)),
+            amount_raw = Env.amount_to_raw(amount),
             giveaway=giveaway
         )
-        await tx.save(using_db=conn)
+        if conn is None:
+            async with in_transaction() as conn:
+                await tx.save(using_db=conn)
+                await Transaction.update_pending(conn, [tx])
+        else:
+            await tx.save(using_db=conn)
+            await Transaction.update_pending(conn, [tx])
         return tx
 
+    @staticmethod
+    async def update_pending(conn, tx_list: List['Transaction'], sign: int = 1):
+        """Add unprocessed transactions to the pending ledger of their users, or remove them with sign=-1"""
+        pending_send = {}
+        pending_receive = {}
+        for tx in tx_list:
+            pending_send[tx.sending_user_id] = pending_send.get(tx.sending_user_id, 0) + sign * int(tx.amount_raw)
+            if tx.receiving_user_id is not None:
+                pending_receive[tx.receiving_user_id] = pending_receive.get(tx.receiving_user_id, 0) + sign * int(tx.amount_raw)
+        await usr.User.update_pending(conn, pending_send, pending_receive)
+
+    @staticmethod
+    async def get_pending_amounts(user_id: int) -> Tuple[int, int]:
+        """Sum of unprocessed amounts sent by and to a user (in RAW)
+            returns a tuple (pending_send, pending_receive)"""
+        pending = Transaction.filter(Q(sending_user_id=user_id) | Q(receiving_user_id=user_id), block_hash=None)
+        if Transaction._meta.db.capabilities.dialect == 'sqlite':
+            # SQLite can't sum beyond 64 bits exactly, add them up here instead
+            pending_send = 0
+            pending_receive = 0
+            for sending_user_id, receiving_user_id, amount_raw in await pending.values_list('sending_user_id', 'receiving_user_id', 'amount_raw'):
+                if sending_user_id == user_id:
+                    pending_send += int(amount_raw)
+                if receiving_user_id == user_id:
+                    pending_receive += int(amount_raw)
+            return (pending_send, pending_receive)
+        totals = await pending.annotate(
+            pending_send=Sum('amount_raw', _filter=Q(sending_user_id=user_id)),
+            pending_receive=Sum('amount_raw', _filter=Q(receiving_user_id=user_id))
+        ).values('pending_send', 'pending_receive')
+        if len(totals) == 0:
+            return (0, 0)
+        return (int(totals[0]['pending_send'] or 0), int(totals[0]['pending_receive'] or 0))
+
+    @staticmethod
+    async def get_giveaway_entries(giveaway_id: int, entry_fee: int, conn = None) -> Tuple[List[int], int]:
+        """IDs of users that paid at least the entry fee in a single transaction, and the sum of all transactions (in RAW)
+            returns a tuple (entrant_ids, total). Given a connection in a transaction, the entries are locked until it ends"""
+        entries = Transaction.filter(giveaway_id=giveaway_id).using_db(conn)
+        if conn is not None and conn.capabilities.dialect == 'postgres':
+            # Donations top up existing entries, hold them off until the giveaway is settled
+            await entries.select_for_update().only('id')
+        if Transaction._meta.db.capabilities.dialect == 'sqlite':
+            # SQLite can't compare or sum beyond 64 bits exactly, do it here instead
+            entrant_ids = set()
+            total = 0
+            for sending_user_id, amount_raw in await entries.values_list('sending_user_id', 'amount_raw'):
+                if int(amount_raw) >= entry_fee:
+                    entrant_ids.add(sending_user_id)
+                total += int(amount_raw)
+            return (list(entrant_ids), total)
+        per_user = await entries.annotate(
+            total=Sum('amount_raw'),
+            largest=Max('amount_raw')
+        ).group_by('sending_user_id').values('sending_user_id', 'total', 'largest')
+        entrant_ids = [row['sending_user_id'] for row in per_user if int(row['largest']) >= entry_fee]
+        return (entrant_ids, sum(int(row['total']) for row in per_user))
+
+    @staticmethod
+    async def settle_giveaway(conn, giveaway_id: int, winner: usr.User) -> List['Transaction']:
+        """Send every transaction of a giveaway to its winner and drop the empty ones,
+            returns the transactions to queue"""
+        destination = await winner.get_address()
+        await Transaction.filter(giveaway_id=giveaway_id, amount_raw=0).using_db(conn).delete()
+        await Transaction.filter(giveaway_id=giveaway_id, receiving_user_id=None).using_db(conn).update(
+            destination=destination,
+            receiving_user_id=winner.id
+        )
+        txs = await Transaction.filter(giveaway_id=giveaway_id, receiving_user_id=winner.id, block_hash=None).using_db(conn).prefetch_related('sending_user', 'receiving_user')
+        # The winner now has the whole pot incoming
+        await usr.User.update_pending(conn, pending_receive={winner.id: sum(int(tx.amount_raw) for tx in txs)})
+        return txs
+
+    @staticmethod
+    async def refund_giveaway(conn, giveaway_id: int) -> int:
+        """Give back the entries of a giveaway that ended without a winner,
+            they were never sent so dropping them returns the amounts. Returns number of transactions"""
+        txs = await Transaction.filter(giveaway_id=giveaway_id, block_hash=None).using_db(conn)
+        await Transaction.filter(id__in=[tx.id for tx in txs]).using_db(conn).delete()
+        await Transaction.update_pending(conn, txs, sign=-1)
+        return len(txs)
+
+    async def claim(self) -> bool:
+        """Reserve this transaction for sending, False if it's already sent or another consumer holds it"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return await Transaction.filter(
+            Q(lease_until=None) | Q(lease_until__lt=now),
+            id=self.id,
+            block_hash=None
+        ).update(lease_until=now + datetime.timedelta(seconds=LEASE_DURATION)) > 0
+
+    async def fail(self, delay: float):
+        """Record a failed send, the transaction becomes available again after delay seconds"""
+        self.attempts += 1
+        await Transaction.filter(id=self.id, block_hash=None).update(
+            attempts=self.attempts,
+            lease_until=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay)
+        )
+
+    async def move_to_dead_letters(self) -> 'DeadLetter':
+        """Record a final failed send, it's not retried until an admin replays it"""
+        self.attempts += 1
+        async with in_transaction() as conn:
+            await Transaction.filter(id=self.id).using_db(conn).update(attempts=self.attempts, lease_until=None)
+            # May already be dead lettered, e.g. if it was sent again before the admin replayed it
+            dead_letter, created = await DeadLetter.get_or_create(
+                transaction_id=self.id,
+                defaults={'attempts': self.attempts},
+                using_db=conn
+            )
+            if not created:
+                dead_letter.attempts = self.attempts
+                await dead_letter.save(update_fields=['attempts'], using_db=conn)
+        return dead_letter
+
+    @staticmethod
+    def _due(*args, **kwargs):
+        """Unsent transactions that may be attempted again, dead lettered ones wait for an admin"""
+        return Transaction.filter(
+            *args,
+            block_hash=None,
+            destination__not_isnull=True,
+            attempts__lt=MAX_SEND_ATTEMPTS,
+            dead_letter=None,
+            **kwargs
+        ).order_by('created_at').prefetch_related('sending_user', 'receiving_user')
+
+    @staticmethod
+    async def get_expired(limit: int = 1000) -> List['Transaction']:
+        """Unsent transactions that are due for another attempt,
+            whose lease ran out or that nobody claimed in time"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return await Transaction._due(
+            Q(lease_until__lt=now) | Q(lease_until=None, created_at__lt=now - datetime.timedelta(seconds=LEASE_DURATION))
+        ).limit(limit)
+
+    @staticmethod
+    async def get_unprocessed() -> List['Transaction']:
+        """Unsent transactions that nobody holds a lease on, e.g. left over from a previous leader"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return await Transaction._due(Q(lease_until=None) | Q(lease_until__lt=now))
+
     async def send(self) -> str:
         if self.block_hash is not None:
             return self.block_hash
@@ -113,7 +318,42 @@ class Transaction(Model):
             amount=self.amount
         )
         if resp is not None:
+            # Balances changed, drop them before the pending amount is cleared
+            await BalanceCache.instance().invalidate(await self.sending_user.get_address(), self.destination)
             async with in_transaction() as conn:
                 self.block_hash = resp
-                await self.save(using_db=conn)
+                # Only the first to record the hash takes it off the ledger
+                if await Transaction.filter(id=self.id, block_hash=None).using_db(conn).update(block_hash=resp) > 0:
+                    await Transaction.update_pending(conn, [self], sign=-1)
+                    # It went through after all
+                    await DeadLetter.filter(transaction_id=self.id).using_db(conn).delete()
         return resp
+
+class DeadLetter(Model):
+    """Transactions that kept failing to send"""
+    id = fields.IntField(pk=True)
+    transaction = fields.OneToOneField('db.Transaction', related_name='dead_letter')
+    attempts = fields.IntField()
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = 'dead_letters'
+
+    @staticmethod
+    async def get_all() -> List['DeadLetter']:
+        return await DeadLetter.all().order_by('created_at').prefetch_related('transaction', 'transaction__sending_user')
+
+    @staticmethod
+    async def replay(transaction_ids: List[str] = None) -> List[Transaction]:
+        """Give dead lettered transactions a fresh set of attempts, all of them if no IDs are given.
+            Returns the transactions to queue"""
+        dead_letters = DeadLetter.all()
+        if transaction_ids is not None:
+            dead_letters = dead_letters.filter(transaction_id__in=transaction_ids)
+        ids = await dead_letters.values_list('transaction_id', flat=True)
+        if len(ids) == 0:
+            return []
+        async with in_transaction() as conn:
+            await DeadLetter.filter(transaction_id__in=ids).using_db(conn).delete()
+            await Transaction.filter(id__in=ids, block_hash=None).using_db(conn).update(attempts=0, lease_until=None)
+        return await Transaction.filter(id__in=ids, block_hash=None).prefetch_related('sending_user', 'receiving_user')
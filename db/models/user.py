@@ -1,16 +1,36 @@
 import datetime
+import rapidjson as json
 
 import discord
+from decimal import Decimal
+from typing import Dict, List, Set, Tuple
 from tortoise import fields
+from tortoise.expressions import F
 from tortoise.models import Model
 from tortoise.transactions import in_transaction
 
 import db.models.account as acct
 import db.models.stats as stats
+from db.fields import RawAmountField
+from db.redis import RedisDB
 from models.constants import Constants
-from rpc.client import RPCClient
+from rpc.balance_cache import BalanceCache
+from util.cache import LRUCache
 from util.env import Env
 
+# Users kept in memory, and how long (in seconds) before they're read from the database again
+USER_CACHE_SIZE = 5000
+USER_CACHE_TTL = 300
+
+# Upper bound on how long a missed invalidation of the muted by cache could last
+MUTED_BY_CACHE_EXPIRY = 600
+
+REBUILD_PENDING_SQL = """
+UPDATE users SET
+    pending_send_raw = COALESCE((SELECT SUM(t.amount_raw) FROM transactions t WHERE t.sending_user_id = users.id AND t.block_hash IS NULL), 0),
+    pending_receive_raw = COALESCE((SELECT SUM(t.amount_raw) FROM transactions t WHERE t.receiving_user_id = users.id AND t.block_hash IS NULL), 0)
+"""
+
 class User(Model):
     id = fields.BigIntField(pk=True, generated=False)
     name = fields.CharField(max_length=50)
@@ -18,14 +38,41 @@ class User(Model):
     modified_at = fields.DatetimeField(auto_now=True)
     frozen = fields.BooleanField(default=False) # Completely banned
     tip_banned = fields.BooleanField(default=False) # Can't receive tips
+    pending_send_raw = RawAmountField(default=0) # Sum of unprocessed transactions sent by this user
+    pending_receive_raw = RawAmountField(default=0) # Sum of unprocessed transactions sent to this user
+
+    # Recently used users with their account prefetched
+    _cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
     class Meta:
         table = "users"
 
+    @classmethod
+    async def _fetch(cls, user_id: int) -> 'User':
+        """Get a user with their account, from the cache if possible"""
+        dbuser: 'User' = cls._cache.get(user_id)
+        if dbuser is None:
+            dbuser = await cls.filter(id=user_id).prefetch_related('account').first()
+            if dbuser is not None:
+                cls._cache.put(user_id, dbuser)
+        return dbuser
+
+    @classmethod
+    async def invalidate_cache(cls, user_ids: List[int]):
+        """Forget cached users in every bot process, must be called whenever their row is changed outside of the User object"""
+        cls.drop_cached(user_ids)
+        await RedisDB.instance().publish_event('invalidate_users', user_ids=list(user_ids))
+
+    @classmethod
+    def drop_cached(cls, user_ids: List[int]):
+        """Forget cached users in this process"""
+        for user_id in user_ids:
+            cls._cache.pop(user_id)
+
     @classmethod
     async def create_or_fetch_user(cls, user: discord.User) -> 'User':
         """Create a user if they don't exist, raises OperationalError if database error occurs"""
-        dbuser: 'User' = await cls.filter(id=user.id).prefetch_related('account').first()
+        dbuser: 'User' = await cls._fetch(user.id)
         if dbuser is None:
             async with in_transaction() as conn:
                 # Create user and return them
@@ -35,25 +82,44 @@ class User(Model):
                 )
                 await dbuser.save(using_db=conn)
                 # Create an account
-                address = await RPCClient.instance().account_create()
-                if address is None:
-                    raise Exception("RPC account create failed")
                 account = acct.Account(
                     user = dbuser,
-                    address = address
+                    address = await acct.Account.create_address(conn)
                 )
                 await account.save(using_db=conn)
         return dbuser
 
+    @classmethod
+    async def create_or_fetch_users(cls, users: List[discord.User]) -> List['User']:
+        """Create or fetch multiple users, users that aren't cached are fetched with a single query"""
+        found = {}
+        for u in users:
+            # A single lookup, an entry can expire between a membership check and a get
+            dbuser = cls._cache.get(u.id)
+            if dbuser is not None:
+                found[u.id] = dbuser
+        missing_ids = [u.id for u in users if u.id not in found]
+        if len(missing_ids) > 0:
+            for dbuser in await cls.filter(id__in=missing_ids).prefetch_related('account').all():
+                cls._cache.put(dbuser.id, dbuser)
+                found[dbuser.id] = dbuser
+        ret = []
+        for user in users:
+            if user.id in found:
+                ret.append(found[user.id])
+            else:
+                ret.append(await cls.create_or_fetch_user(user))
+        return ret
+
     @classmethod
     async def get_user(cls, user: discord.User) -> 'User':
         """Get discord user from database, return None if they haven't registered"""
-        return await cls.filter(id=user.id).prefetch_related('account').first()
+        return await cls._fetch(user.id)
 
     @classmethod
     async def get_user_id(cls, user: int) -> 'User':
         """Get discord user from database, return None if they haven't registered"""
-        return await cls.filter(id=user).prefetch_related('account').first()
+        return await cls._fetch(user)
 
     async def update_name(self, name: str):
         """Update discord user name in database"""
@@ -61,6 +127,7 @@ class User(Model):
             self.name = name.replace("`", "")
             async with in_transaction() as conn:
                 await self.save(update_fields=['name'], using_db=conn)
+            await User.invalidate_cache([self.id])
 
     async def get_address(self) -> str:
         """Get account address of user"""
@@ -70,16 +137,13 @@ class User(Model):
         if account is not None:
             return account.address
         # Create an account
-        address = await RPCClient.instance().account_create()
-        if address is None:
-            raise Exception("RPC account create failed")
-        account = acct.Account(
-            user = self,
-            address = address
-        )
         async with in_transaction() as conn:
+            account = acct.Account(
+                user = self,
+                address = await acct.Account.create_address(conn)
+            )
             await account.save(using_db=conn)
-        return address
+        return account.address
 
     async def get_stats(self, server_id: int) -> stats.Stats:
         """Return Stats object for this user for the given server"""
@@ -93,31 +157,60 @@ class User(Model):
                 await user_stats.save(using_db=conn)
         return user_stats
 
-    async def get_pending(self) -> int:
+    async def get_pending(self) -> Tuple[int, int]:
         """Get pending amounts in internal database as a sum (in RAW)
             returns a tuple (pending_send, pending_receive)"""
-        sent_transactions = await self.sent_transactions.filter(block_hash=None).all()
-        received_transactions = await self.received_transactions.filter(block_hash=None).all()
-        pending_send = 0
-        pending_receive = 0
-        for stx in sent_transactions:
-            pending_send += int(stx.amount)
-        for ptx in received_transactions:
-            pending_receive += int(ptx.amount)
-        return (pending_send, pending_receive)
+        pending = await User.filter(id=self.id).values_list('pending_send_raw', 'pending_receive_raw')
+        if len(pending) > 0:
+            self.pending_send_raw, self.pending_receive_raw = int(pending[0][0]), int(pending[0][1])
+        return (self.pending_send_raw, self.pending_receive_raw)
+
+    @classmethod
+    async def update_pending(cls, conn, pending_send: Dict[int, int] = {}, pending_receive: Dict[int, int] = {}):
+        """Apply changes to the pending ledger of users, keyed by user ID (in RAW)
+            must run on the same connection as the transaction rows being changed"""
+        # Users with identical changes (e.g. all receivers of a rain) are updated together
+        groups = {}
+        for user_id in set(pending_send) | set(pending_receive):
+            delta = (pending_send.get(user_id, 0), pending_receive.get(user_id, 0))
+            if delta != (0, 0):
+                groups.setdefault(delta, []).append(user_id)
+        for (send_delta, receive_delta), user_ids in groups.items():
+            if conn.capabilities.dialect == 'sqlite':
+                # SQLite arithmetic loses precision beyond 64 bits, its writes are serialized anyway
+                for u in await cls.filter(id__in=user_ids).using_db(conn).all():
+                    u.pending_send_raw = int(u.pending_send_raw) + send_delta
+                    u.pending_receive_raw = int(u.pending_receive_raw) + receive_delta
+                    await u.save(update_fields=['pending_send_raw', 'pending_receive_raw'], using_db=conn)
+            else:
+                await cls.filter(id__in=user_ids).using_db(conn).update(
+                    pending_send_raw=F('pending_send_raw') + Decimal(send_delta),
+                    pending_receive_raw=F('pending_receive_raw') + Decimal(receive_delta)
+                )
+
+    @classmethod
+    async def rebuild_pending(cls):
+        """Recompute the pending ledger of every user from unprocessed transactions"""
+        async with in_transaction() as conn:
+            if conn.capabilities.dialect == 'sqlite':
+                for u in await cls.all().using_db(conn):
+                    u.pending_send_raw, u.pending_receive_raw = await u.sent_transactions.remote_model.get_pending_amounts(u.id)
+                    await u.save(update_fields=['pending_send_raw', 'pending_receive_raw'], using_db=conn)
+            else:
+                await conn.execute_script(REBUILD_PENDING_SQL)
 
     async def get_available_balance(self) -> int:
         """Get available balance of user (in RAW)"""
         address = await self.get_address()
         pending_send, pending_receive = await self.get_pending()
-        actual = await RPCClient.instance().account_balance(address, False)
+        actual = await BalanceCache.instance().account_balance(address, False)
         return int(actual['balance']) - pending_send
 
     async def get_available_balance_dec(self) -> float:
         """Get available balance of user (in normal unit)"""
         address = await self.get_address()
         pending_send, pending_receive = await self.get_pending()
-        actual = await RPCClient.instance().account_balance(address, True)
+        actual = await BalanceCache.instance().account_balance(address, True)
         available = int(actual['balance']) - pending_send
         return Env.raw_to_amount(available)
 
@@ -131,10 +224,18 @@ class User(Model):
         delta = (datetime.datetime.now(datetime.timezone.utc) - last_withdraw.created_at).total_seconds()
         return int(Constants.WITHDRAW_COOLDOWN - delta)
 
+    async def get_muted_by_ids(self) -> Set[int]:
+        """IDs of every user that has muted this user, cached until someone mutes or unmutes them"""
+        cached = await RedisDB.instance().get(f"mutedby:{self.id}")
+        if cached is not None:
+            return set(json.loads(cached))
+        muted_by_ids = await self.muted_by.all().values_list('user_id', flat=True)
+        await RedisDB.instance().set(f"mutedby:{self.id}", json.dumps(list(muted_by_ids)), expires=MUTED_BY_CACHE_EXPIRY)
+        return set(muted_by_ids)
+
     async def is_muted_by(self, user_id: int) -> bool:
         """Returns true if this user has been muted by passed in"""
-        muted = await self.muted_by.filter(user__id=user_id).count()
-        return muted > 0
+        return user_id in await self.get_muted_by_ids()
 
     def __eq__(self, other: 'User'):
         """Overrides the default equality implementation"""
@@ -1,9 +1,180 @@
 import aioredis
 import asyncio
+import hashlib
 import os
+import time
 
+from typing import Dict, List, Tuple
 from util.env import Env
 
+# Activity entries expire this many seconds after they were last updated
+ACTIVITY_EXPIRY = 1800
+
+# KEYS[1] = activity count index, KEYS[2] = activity last_msg index
+# ARGV[1] = expiry, ARGV[2] = max msg_count, followed by (user_id, first_msg, last_msg) for each user
+# Messages within 90s of the last counted one are ignored, a gap of more than 1200s costs a point,
+# anything in between earns a point up to the maximum
+UPDATE_ACTIVITY_SCRIPT = """
+local expiry = tonumber(ARGV[1])
+local max_count = tonumber(ARGV[2])
+local function count_message(user_id, now)
+    local count = redis.call('ZSCORE', KEYS[1], user_id)
+    local last = redis.call('ZSCORE', KEYS[2], user_id)
+    if not count or not last or now - tonumber(last) > expiry then
+        count = 1
+    else
+        count = tonumber(count)
+        local delta = now - tonumber(last)
+        if delta < 90 then
+            return
+        elseif delta > 1200 then
+            if count > 1 then
+                count = count - 1
+            end
+        elseif count <= max_count then
+            count = count + 1
+        end
+    end
+    redis.call('ZADD', KEYS[1], count, user_id)
+    redis.call('ZADD', KEYS[2], now, user_id)
+end
+for i = 3, #ARGV, 3 do
+    count_message(ARGV[i], tonumber(ARGV[i + 1]))
+    if ARGV[i + 2] ~= ARGV[i + 1] then
+        count_message(ARGV[i], tonumber(ARGV[i + 2]))
+    end
+end
+redis.call('EXPIRE', KEYS[1], expiry)
+redis.call('EXPIRE', KEYS[2], expiry)
+return (#ARGV - 2) / 3
+"""
+
+# KEYS[1] = activity count index, KEYS[2] = activity last_msg index
+# ARGV[1] = user_id, ARGV[2] = now, ARGV[3] = expiry, ARGV[4] = min msg_count
+ACTIVITY_MINIMUM_SCRIPT = """
+local now = tonumber(ARGV[2])
+local expiry = tonumber(ARGV[3])
+local count = redis.call('ZSCORE', KEYS[1], ARGV[1])
+local last = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if not count or not last or now - tonumber(last) > expiry or tonumber(count) < tonumber(ARGV[4]) then
+    count = tonumber(ARGV[4])
+else
+    count = tonumber(count)
+end
+redis.call('ZADD', KEYS[1], count, ARGV[1])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('EXPIRE', KEYS[1], expiry)
+redis.call('EXPIRE', KEYS[2], expiry)
+return count
+"""
+
+# Rebuilt leaderboards are trusted for this long before being read from the database again
+LEADERBOARD_EXPIRY = 3600
+
+# KEYS = leaderboards to update, ARGV[1] = amount, ARGV[2] = user_id
+# Leaderboards that aren't cached are left alone, they're rebuilt in full on the next read
+LEADERBOARD_INCR_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZINCRBY', key, ARGV[1], ARGV[2])
+    end
+end
+"""
+
+# KEYS[1] = giveaway schedule, ARGV[1] = now
+# Returns the IDs of giveaways that are due and takes them off the schedule
+GIVEAWAY_TAKE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, giveaway_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], giveaway_id)
+end
+return due
+"""
+
+# KEYS[1] = recipient order, KEYS[2] = pending recipients, KEYS[3] = recipient's messages
+# ARGV[1] = user_id, ARGV[2] = message
+# A recipient is only queued once, later messages are delivered along with the first
+DM_ENQUEUE_SCRIPT = """
+redis.call('RPUSH', KEYS[3], ARGV[2])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+"""
+
+# KEYS[1] = recipient order, KEYS[2] = pending recipients, KEYS[3] = recipients being delivered to
+# ARGV[1] = messages key prefix, ARGV[2] = in flight messages key prefix, ARGV[3] = now, ARGV[4] = lease
+# Deliveries that weren't acknowledged before their lease ran out are queued again, in front.
+# Returns the next recipient nobody is delivering to, followed by all of their messages,
+# the messages are kept in flight until they're acknowledged
+DM_TAKE_SCRIPT = """
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[3])) do
+    redis.call('ZREM', KEYS[3], user_id)
+    local messages = redis.call('LRANGE', ARGV[2] .. user_id, 0, -1)
+    for i = #messages, 1, -1 do
+        redis.call('LPUSH', ARGV[1] .. user_id, messages[i])
+    end
+    redis.call('DEL', ARGV[2] .. user_id)
+    if #messages > 0 and redis.call('SADD', KEYS[2], user_id) == 1 then
+        redis.call('LPUSH', KEYS[1], user_id)
+    end
+end
+for _ = 1, redis.call('LLEN', KEYS[1]) do
+    local user_id = redis.call('LPOP', KEYS[1])
+    if redis.call('ZSCORE', KEYS[3], user_id) then
+        -- Messages to one recipient are delivered in order, wait for the running delivery
+        redis.call('RPUSH', KEYS[1], user_id)
+    else
+        redis.call('SREM', KEYS[2], user_id)
+        if redis.call('EXISTS', ARGV[1] .. user_id) == 1 then
+            redis.call('RENAME', ARGV[1] .. user_id, ARGV[2] .. user_id)
+            redis.call('ZADD', KEYS[3], tonumber(ARGV[3]) + tonumber(ARGV[4]), user_id)
+            local messages = redis.call('LRANGE', ARGV[2] .. user_id, 0, -1)
+            table.insert(messages, 1, user_id)
+            return messages
+        end
+    end
+end
+return nil
+"""
+
+# KEYS[1] = receive queue, KEYS[2] = account's last receive time
+# ARGV[1] = address, ARGV[2] = now, ARGV[3] = cooldown
+# An account is only queued once, and not sooner than cooldown after its last receive
+RECEIVE_ENQUEUE_SCRIPT = """
+local due = tonumber(ARGV[2])
+local last = redis.call('GET', KEYS[2])
+if last then
+    due = math.max(due, tonumber(last) + tonumber(ARGV[3]))
+end
+return redis.call('ZADD', KEYS[1], 'NX', due, ARGV[1])
+"""
+
+# KEYS[1] = receive queue
+# ARGV[1] = now, ARGV[2] = max accounts, ARGV[3] = last receive key prefix, ARGV[4] = cooldown
+# Returns accounts that are due and records their receive time
+RECEIVE_TAKE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, address in ipairs(due) do
+    redis.call('ZREM', KEYS[1], address)
+    redis.call('SET', ARGV[3] .. address, ARGV[1], 'EX', tonumber(ARGV[4]))
+end
+return due
+"""
+
+# KEYS[1] = admin role holders of the guild
+# ARGV[1] = user's guilds key prefix, ARGV[2] = guild_id, followed by the user IDs now holding an admin role
+# Replaces the admin role holders of a guild
+ADMIN_ROLES_SET_SCRIPT = """
+for _, user_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('SREM', ARGV[1] .. user_id, ARGV[2])
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV do
+    redis.call('SADD', KEYS[1], ARGV[i])
+    redis.call('SADD', ARGV[1] .. ARGV[i], ARGV[2])
+end
+"""
+
 class RedisDB(object):
     _instance = None
 
@@ -79,3 +250,249 @@ class RedisDB(object):
         key = f"{Env.currency_name().lower()}:botpaused"
         redis = await self.get_redis()
         return (await redis.get(key)) is not None
+
+
+    def _cluster_channel(self) -> str:
+        return f"{Env.currency_name().lower()}cluster"
+
+    async def publish_event(self, event: str, **data):
+        """Tell every bot process about something, see tasks.cluster"""
+        redis = await self.get_redis()
+        data['event'] = event
+        await redis.publish_json(self._cluster_channel(), data)
+
+    async def subscribe_events(self) -> aioredis.Channel:
+        redis = await self.get_redis()
+        channel, = await redis.subscribe(self._cluster_channel())
+        return channel
+
+    def _activity_keys(self, guild_id: int) -> Tuple[str, str]:
+        """Per-guild activity index keys
+            activityindex is a sorted set of user_id scored by msg_count
+            activitylast is a sorted set of user_id scored by last_msg (unix timestamp)"""
+        prefix = Env.currency_name().lower()
+        return f"{prefix}activityindex:{guild_id}", f"{prefix}activitylast:{guild_id}"
+
+    async def _run_script(self, script: str, keys: List[str], args: list):
+        """Run a lua script by its SHA, loading it into redis first if necessary"""
+        redis = await self.get_redis()
+        sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        try:
+            return await redis.evalsha(sha, keys=keys, args=args)
+        except aioredis.errors.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return await redis.eval(script, keys=keys, args=args)
+
+    async def update_activity(self, guild_id: int, activity: Dict[int, Tuple[float, float]], max_count: int):
+        """Count chat messages towards activity of users in a guild
+            activity maps user_id to the (first, last) message timestamps seen since the last update"""
+        if len(activity) == 0:
+            return
+        args = [ACTIVITY_EXPIRY, max_count]
+        for user_id, (first_msg, last_msg) in activity.items():
+            args.extend([user_id, first_msg, last_msg])
+        await self._run_script(
+            UPDATE_ACTIVITY_SCRIPT,
+            keys=list(self._activity_keys(guild_id)),
+            args=args
+        )
+
+    async def set_activity_minimum(self, guild_id: int, user_id: int, min_count: int) -> int:
+        """Raise a user's activity to at least min_count, returns their new msg_count"""
+        return await self._run_script(
+            ACTIVITY_MINIMUM_SCRIPT,
+            keys=list(self._activity_keys(guild_id)),
+            args=[user_id, time.time(), ACTIVITY_EXPIRY, min_count]
+        )
+
+    async def get_active_user_ids(self, guild_id: int, min_count: int) -> List[int]:
+        """Return IDs of users in the guild with at least min_count activity points"""
+        count_key, last_key = self._activity_keys(guild_id)
+        redis = await self.get_redis()
+        # Drop expired entries
+        expired = await redis.zrangebyscore(last_key, max=time.time() - ACTIVITY_EXPIRY)
+        if len(expired) > 0:
+            tr = redis.multi_exec()
+            tr.zrem(count_key, *expired)
+            tr.zrem(last_key, *expired)
+            await tr.execute()
+        return [int(u) for u in await redis.zrangebyscore(count_key, min=min_count)]
+
+    def _leaderboard_key(self, board: str, server_id: int) -> str:
+        """Sorted set of user_id scored by tipped amount, board is ballers or legacyboard"""
+        return f"{Env.currency_name().lower()}{board}:{server_id}"
+
+    def _leaderboard_index_key(self) -> str:
+        """Set of the keys of every cached leaderboard"""
+        return f"{Env.currency_name().lower()}leaderboards"
+
+    async def leaderboard_incr(self, server_id: int, user_id: int, amount: float):
+        """Add a tip to the cached leaderboards of a server"""
+        await self._run_script(
+            LEADERBOARD_INCR_SCRIPT,
+            keys=[self._leaderboard_key('ballers', server_id), self._leaderboard_key('legacyboard', server_id)],
+            args=[amount, user_id]
+        )
+
+    async def leaderboard_get(self, board: str, server_id: int, count: int) -> List[int]:
+        """Return the top user IDs of a cached leaderboard, None if it isn't cached"""
+        redis = await self.get_redis()
+        key = self._leaderboard_key(board, server_id)
+        tr = redis.multi_exec()
+        tr.exists(key)
+        tr.zrevrange(key, 0, count - 1)
+        exists, user_ids = await tr.execute()
+        if not exists:
+            return None
+        return [int(u) for u in user_ids]
+
+    async def leaderboard_set(self, board: str, server_id: int, scores: Dict[int, float]):
+        """Replace a cached leaderboard"""
+        if len(scores) == 0:
+            return
+        redis = await self.get_redis()
+        key = self._leaderboard_key(board, server_id)
+        pairs = []
+        for user_id, score in scores.items():
+            pairs.extend([score, user_id])
+        tr = redis.multi_exec()
+        tr.delete(key)
+        tr.zadd(key, *pairs)
+        tr.expire(key, LEADERBOARD_EXPIRY)
+        tr.sadd(self._leaderboard_index_key(), key)
+        await tr.execute()
+
+    async def leaderboard_remove(self, server_id: int, user_ids: List[int]):
+        """Take users off the cached leaderboards of a server"""
+        if len(user_ids) == 0:
+            return
+        redis = await self.get_redis()
+        tr = redis.multi_exec()
+        for board in ['ballers', 'legacyboard']:
+            tr.zrem(self._leaderboard_key(board, server_id), *user_ids)
+        await tr.execute()
+
+    async def leaderboard_clear(self, server_id: int = None):
+        """Drop cached leaderboards of a server, or of every server"""
+        redis = await self.get_redis()
+        index_key = self._leaderboard_index_key()
+        if server_id is not None:
+            keys = [self._leaderboard_key('ballers', server_id), self._leaderboard_key('legacyboard', server_id)]
+        else:
+            # Expired leaderboards stay in the index until they're cleared, deleting them again is harmless
+            keys = await redis.smembers(index_key)
+        if len(keys) == 0:
+            return
+        tr = redis.multi_exec()
+        tr.delete(*keys)
+        tr.srem(index_key, *keys)
+        await tr.execute()
+
+    def _giveaway_schedule_key(self) -> str:
+        """Sorted set of giveaway IDs scored by end_at (unix timestamp)"""
+        return f"{Env.currency_name().lower()}giveawayschedule"
+
+    async def giveaway_schedule(self, giveaway_id: int, end_at: float):
+        """Have a giveaway ended at end_at"""
+        redis = await self.get_redis()
+        await redis.zadd(self._giveaway_schedule_key(), end_at, giveaway_id)
+
+    async def giveaway_take_due(self) -> List[int]:
+        """IDs of giveaways that should be ended now, each one is only returned once"""
+        return [int(g) for g in await self._run_script(GIVEAWAY_TAKE_SCRIPT, keys=[self._giveaway_schedule_key()], args=[time.time()])]
+
+    async def giveaway_next_due(self) -> float:
+        """When the next giveaway ends, None if there aren't any"""
+        redis = await self.get_redis()
+        first = await redis.zrange(self._giveaway_schedule_key(), 0, 0, withscores=True)
+        return first[0][1] if len(first) > 0 else None
+
+    def _dm_keys(self) -> Tuple[str, str, str, str, str]:
+        """DM queue keys: recipient order (list), pending recipients (set), recipients being delivered to
+            (sorted set scored by lease expiry) and the prefixes of the queued and in flight message lists"""
+        prefix = Env.currency_name().lower()
+        return f"{prefix}dmqueue", f"{prefix}dmqueue:pending", f"{prefix}dmqueue:processing", f"{prefix}dmqueue:messages:", f"{prefix}dmqueue:inflight:"
+
+    async def dm_enqueue(self, user_id: int, message: str):
+        """Queue a DM to a user"""
+        order_key, pending_key, _, messages_prefix, _ = self._dm_keys()
+        await self._run_script(
+            DM_ENQUEUE_SCRIPT,
+            keys=[order_key, pending_key, f"{messages_prefix}{user_id}"],
+            args=[user_id, message]
+        )
+
+    async def dm_take(self, lease: int) -> Tuple[int, List[str]]:
+        """Take the next recipient and their messages off the queue, None if it's empty.
+            They're queued again unless dm_ack is called within lease seconds"""
+        order_key, pending_key, processing_key, messages_prefix, inflight_prefix = self._dm_keys()
+        ret = await self._run_script(
+            DM_TAKE_SCRIPT,
+            keys=[order_key, pending_key, processing_key],
+            args=[messages_prefix, inflight_prefix, time.time(), lease]
+        )
+        if ret is None:
+            return None
+        return int(ret[0]), ret[1:]
+
+    async def dm_ack(self, user_id: int):
+        """Messages taken for a user are done with"""
+        _, _, processing_key, _, inflight_prefix = self._dm_keys()
+        redis = await self.get_redis()
+        tr = redis.multi_exec()
+        tr.zrem(processing_key, user_id)
+        tr.delete(f"{inflight_prefix}{user_id}")
+        await tr.execute()
+
+    def _receive_keys(self) -> Tuple[str, str]:
+        """Sorted set of addresses scored by when they're due to receive, and the prefix of their last receive times"""
+        prefix = Env.currency_name().lower()
+        return f"{prefix}receivequeue", f"{prefix}receivequeue:last:"
+
+    async def receive_enqueue(self, address: str, cooldown: int):
+        """Queue a receive for an account, not sooner than cooldown seconds after its last one"""
+        queue_key, last_prefix = self._receive_keys()
+        await self._run_script(
+            RECEIVE_ENQUEUE_SCRIPT,
+            keys=[queue_key, f"{last_prefix}{address}"],
+            args=[address, time.time(), cooldown]
+        )
+
+    async def receive_take(self, count: int, cooldown: int) -> List[str]:
+        """Take up to count accounts that are due off the receive queue"""
+        queue_key, last_prefix = self._receive_keys()
+        return await self._run_script(
+            RECEIVE_TAKE_SCRIPT,
+            keys=[queue_key],
+            args=[time.time(), count, last_prefix, cooldown]
+        )
+
+    def _admin_role_keys(self, guild_id: int) -> Tuple[str, str]:
+        """Set of users holding an admin role in the guild, and the prefix of the sets of guilds a user holds one in"""
+        prefix = Env.currency_name().lower()
+        return f"{prefix}adminroles:{guild_id}", f"{prefix}adminroles:user:"
+
+    async def admin_roles_set(self, guild_id: int, user_ids: List[int]):
+        """Replace the users holding an admin role in a guild"""
+        guild_key, user_prefix = self._admin_role_keys(guild_id)
+        await self._run_script(ADMIN_ROLES_SET_SCRIPT, keys=[guild_key], args=[user_prefix, guild_id] + list(user_ids))
+
+    async def admin_roles_update(self, guild_id: int, user_id: int, has_role: bool):
+        """Record whether a user holds an admin role in a guild"""
+        guild_key, user_prefix = self._admin_role_keys(guild_id)
+        redis = await self.get_redis()
+        tr = redis.multi_exec()
+        if has_role:
+            tr.sadd(guild_key, user_id)
+            tr.sadd(f"{user_prefix}{user_id}", guild_id)
+        else:
+            tr.srem(guild_key, user_id)
+            tr.srem(f"{user_prefix}{user_id}", guild_id)
+        await tr.execute()
+
+    async def has_admin_role(self, user_id: int) -> bool:
+        """Whether a user holds an admin role in any guild"""
+        _, user_prefix = self._admin_role_keys(0)
+        redis = await self.get_redis()
+        return await redis.exists(f"{user_prefix}{user_id}") > 0
@@ -3,6 +3,8 @@ import os
 from tortoise import Tortoise
 from tortoise.contrib.aiohttp import register_tortoise
 
+from db.migrations import run_migrations
+
 class DBConfig(object):
     def __init__(self):
         self.logger = logging.getLogger()
@@ -29,6 +31,11 @@ class DBConfig(object):
         register_tortoise(app, db_url=self.get_db_url(),
                           modules=self.modules,
                           generate_schemas=True)
+        # Runs after register_tortoise's own startup hook, the server may start before the bot ever did
+        app.on_startup.append(self._run_migrations)
+
+    async def _run_migrations(self, app):
+        await run_migrations()
 
     async def init_db(self):
         await Tortoise.init(
@@ -37,3 +44,5 @@ class DBConfig(object):
         )
         # Create tables
         await Tortoise.generate_schemas(safe=True)
+        # Update existing tables
+        await run_migrations()
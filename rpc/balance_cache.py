@@ -0,0 +1,80 @@
+import rapidjson as json
+
+from config import Config
+from db.redis import RedisDB
+from rpc.client import RPCClient
+from util.cache import LRUCache
+from util.env import Env
+
+# Invalidation counters outlive any cached balance by a wide margin
+GENERATION_EXPIRY = 86400
+# Balances kept in memory
+BALANCE_CACHE_SIZE = 5000
+
+class BalanceCache(object):
+    """Short lived cache of account_balance results.
+
+    Every address has a generation counter in redis that is bumped whenever its
+    balance changes, so the bot and the callback server share invalidations.
+    A cached balance is only used while it was fetched under the current generation,
+    a lookup racing with an invalidation can never be served afterwards."""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls) -> 'BalanceCache':
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.ttl = Config.instance().get_balance_cache_ttl()
+            cls.use_redis = Config.instance().get_balance_cache_redis()
+            cls.local = LRUCache(maxsize=BALANCE_CACHE_SIZE, ttl=cls.ttl)
+        return cls._instance
+
+    def _gen_key(self, address: str) -> str:
+        return f"{Env.currency_name().lower()}balancegen:{address}"
+
+    def _balance_key(self, address: str, include_only_confirmed: bool) -> str:
+        return f"{Env.currency_name().lower()}balance:{address}:{int(include_only_confirmed)}"
+
+    async def account_balance(self, address: str, include_only_confirmed: bool) -> dict:
+        """Cached equivalent of RPCClient.account_balance"""
+        if self.ttl <= 0:
+            return await RPCClient.instance().account_balance(address, include_only_confirmed)
+        redis = await RedisDB.instance().get_redis()
+        key = self._balance_key(address, include_only_confirmed)
+        if self.use_redis:
+            gen, cached = await redis.mget(self._gen_key(address), key)
+        else:
+            gen, cached = await redis.get(self._gen_key(address)), None
+        gen = int(gen) if gen is not None else 0
+        # In process
+        entry = self.local.get(key)
+        if entry is not None and entry[0] == gen:
+            return entry[1]
+        # Shared
+        if cached is not None:
+            cached = json.loads(cached)
+            if cached['gen'] == gen:
+                self.local.put(key, (gen, cached['balance']))
+                return cached['balance']
+        balance = await RPCClient.instance().account_balance(address, include_only_confirmed)
+        if balance is not None:
+            self.local.put(key, (gen, balance))
+            if self.use_redis:
+                await redis.set(key, json.dumps({'gen': gen, 'balance': balance}), expire=self.ttl)
+        return balance
+
+    async def invalidate(self, *addresses: str):
+        """Forget cached balances of addresses, must be called as soon as their balance changes"""
+        redis = await RedisDB.instance().get_redis()
+        for address in addresses:
+            if address is None:
+                continue
+            tr = redis.multi_exec()
+            tr.incr(self._gen_key(address))
+            tr.expire(self._gen_key(address), GENERATION_EXPIRY)
+            await tr.execute()
+            for confirmed in [True, False]:
+                self.local.pop(self._balance_key(address, confirmed))
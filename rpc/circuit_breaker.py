@@ -0,0 +1,80 @@
+import time
+
+from collections import deque
+
+# Outcomes of this many recent requests are considered
+WINDOW_SIZE = 20
+# Fewest requests in the window before the error rate counts
+MIN_REQUESTS = 5
+# Error rate that opens the breaker
+MAX_ERROR_RATE = 0.5
+# Seconds an open breaker rejects requests before letting a trial request through
+OPEN_DURATION = 30
+
+class CircuitBreaker(object):
+    """Tracks the health of a node from the outcome of recent requests.
+
+    Closed: requests go through. Once too many of the recent requests fail the
+    breaker opens and rejects everything for OPEN_DURATION, then a single trial
+    request is let through (half open). Its outcome closes or re-opens the breaker."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half open'
+
+    def __init__(self):
+        self.results = deque(maxlen=WINDOW_SIZE)
+        self.latencies = deque(maxlen=WINDOW_SIZE)
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        elif time.monotonic() - self.opened_at < OPEN_DURATION:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def error_rate(self) -> float:
+        if len(self.results) == 0:
+            return 0
+        return self.results.count(False) / len(self.results)
+
+    @property
+    def latency(self) -> float:
+        """Average latency of recent successful requests, in seconds"""
+        if len(self.latencies) == 0:
+            return 0
+        return sum(self.latencies) / len(self.latencies)
+
+    def allow(self) -> bool:
+        """Whether a request may be made now, reserves the trial request when half open"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        elif state == self.HALF_OPEN and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self, latency: float):
+        self.results.append(True)
+        self.latencies.append(latency)
+        if self.opened_at is not None:
+            self.opened_at = None
+            self.results.clear()
+        self.trial_running = False
+
+    def release(self):
+        """A request ended without an outcome, e.g. it was cancelled"""
+        self.trial_running = False
+
+    def record_failure(self):
+        self.results.append(False)
+        if self.opened_at is not None:
+            # Trial request failed
+            self.opened_at = time.monotonic()
+        elif len(self.results) >= MIN_REQUESTS and self.error_rate >= MAX_ERROR_RATE:
+            self.opened_at = time.monotonic()
+        self.trial_running = False
@@ -1,10 +1,91 @@
+import asyncio
 import logging
 import aiohttp
 import rapidjson as json
 import socket
 import os
+import time
 from config import Config
-from typing import List, Tuple
+from rpc.circuit_breaker import CircuitBreaker
+from typing import Dict, List, Tuple
+
+# How long to gather concurrent lookups before sending them as one bulk request
+BATCH_WINDOW = 0.01
+# Most accounts to put in a single bulk request
+BATCH_MAX_ACCOUNTS = 1000
+
+# Timeout profile of actions that aren't plain lookups, wallet actions may have to generate work first
+ACTION_PROFILES = {
+    'send': 'wallet',
+    'receive': 'wallet',
+    'account_representative_set': 'wallet',
+    'account_create': 'create',
+    'accounts_create': 'create',
+}
+# Actions that don't touch the wallet, any node can answer them
+READ_ACTIONS = ['accounts_balances', 'accounts_pending', 'account_info', 'accounts_representatives', 'block_count']
+# Least seconds to wait for a node before asking the next one as well
+HEDGE_MIN_DELAY = 0.25
+
+class NodeUnavailableException(Exception):
+    pass
+
+class NodeConnection(object):
+    """Connection pool, health and usage of a single node.
+        URLs like unix:///run/nano/rpc.sock connect through a unix socket"""
+    def __init__(self, url: str, limit: int, keepalive: int, dns_cache: int):
+        self.url = url
+        self.breaker = CircuitBreaker()
+        self.limit = limit
+        self.requests = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.queued_total = 0
+        self.queue_wait = 0.0
+        self.connections_created = 0
+        self.connections_reused = 0
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(self.on_queued_start)
+        trace.on_connection_queued_end.append(self.on_queued_end)
+        trace.on_connection_create_end.append(self.on_connection_create)
+        trace.on_connection_reuseconn.append(self.on_connection_reuse)
+        if url.startswith('unix://'):
+            connector = aiohttp.UnixConnector(path=url[len('unix://'):], limit=limit, keepalive_timeout=keepalive)
+            self.post_url = 'http://localhost/'
+        else:
+            connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=keepalive, use_dns_cache=True, ttl_dns_cache=dns_cache)
+            self.post_url = url
+        self.session = aiohttp.ClientSession(connector=connector, json_serialize=json.dumps, trace_configs=[trace])
+
+    async def on_queued_start(self, session, ctx, params):
+        self.queued += 1
+        self.queued_total += 1
+        ctx.queued_at = time.monotonic()
+
+    async def on_queued_end(self, session, ctx, params):
+        self.queued -= 1
+        self.queue_wait += time.monotonic() - ctx.queued_at
+
+    async def on_connection_create(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def on_connection_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+
+    def get_stats(self) -> dict:
+        return {
+            'state': self.breaker.state,
+            'error_rate': self.breaker.error_rate,
+            'latency': self.breaker.latency,
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'limit': self.limit,
+            'queued': self.queued,
+            'queued_total': self.queued_total,
+            'queue_wait': self.queue_wait / self.queued_total if self.queued_total > 0 else 0,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused
+        }
 
 class RPCClient(object):
     _instance = None
@@ -17,27 +98,150 @@ class RPCClient(object):
         if cls._instance is None:
             cls._instance = cls.__new__(cls)
             cls.wallet_id = Config.instance().wallet
-            cls.node_url = Config.instance().node_url
-            cls.session = aiohttp.ClientSession(json_serialize=json.dumps)
+            # The first node holds the wallet
+            cls.node_urls = Config.instance().get_node_urls()
+            cls.nodes = {url: NodeConnection(
+                url,
+                limit=Config.instance().get_rpc_connection_limit(),
+                keepalive=Config.instance().get_rpc_keepalive(),
+                dns_cache=Config.instance().get_rpc_dns_cache()
+            ) for url in cls.node_urls}
+            cls.timeouts = {profile: aiohttp.ClientTimeout(total=t) for profile, t in Config.instance().get_rpc_timeouts().items()}
             cls.bpow_key = os.getenv('BPOW_KEY', None)
             cls.logger = logging.getLogger('RPCClient')
+            cls.batches = {}
         return cls._instance
 
     @classmethod
     async def close(cls):
-        if hasattr(cls, 'session') and cls.session is not None:
-            await cls.session.close()
+        if hasattr(cls, 'nodes'):
+            for node in cls.nodes.values():
+                await node.session.close()
         if cls._instance is not None:
             cls._instance = None
 
+    def get_nodes(self, action: str) -> List[str]:
+        """Nodes that can take a request for action right now, healthiest first"""
+        urls = self.node_urls if action in READ_ACTIONS else self.node_urls[:1]
+        available = [u for u in urls if self.nodes[u].breaker.state != CircuitBreaker.OPEN]
+        return sorted(available, key=lambda u: (self.nodes[u].breaker.state != CircuitBreaker.CLOSED, self.nodes[u].breaker.latency))
+
+    def get_stats(self) -> Dict[str, dict]:
+        """Health and connection pool usage of every node"""
+        return {url: node.get_stats() for url, node in self.nodes.items()}
+
+    async def request_node(self, url: str, req_json: dict):
+        node: NodeConnection = self.nodes[url]
+        breaker = node.breaker
+        if not breaker.allow():
+            raise NodeUnavailableException(f"Node {url} is unavailable")
+        start = time.monotonic()
+        node.requests += 1
+        node.in_flight += 1
+        try:
+            async with node.session.post(node.post_url, json=req_json, timeout=self.timeouts[ACTION_PROFILES.get(req_json['action'], 'read')]) as resp:
+                respJson = await resp.json()
+                if resp.status != 200:
+                    self.logger.error(f"RPC request failed with status {resp.status}")
+                    self.logger.error(f"Request: {req_json}")
+                    self.logger.error(f"Response: {respJson}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        finally:
+            node.in_flight -= 1
+        if resp.status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success(time.monotonic() - start)
+        return respJson
+
+    async def hedged_request(self, urls: List[str], req_json: dict):
+        """Ask the healthiest node first, and the next one as well if it fails or is slow to answer.
+            Returns the first successful response"""
+        remaining = list(urls)
+        pending = set()
+        error = None
+        try:
+            while True:
+                timeout = None
+                if len(remaining) > 0:
+                    url = remaining.pop(0)
+                    pending.add(asyncio.ensure_future(self.request_node(url, req_json)))
+                    if len(remaining) > 0:
+                        timeout = max(HEDGE_MIN_DELAY, 2 * self.nodes[url].breaker.latency)
+                elif len(pending) == 0:
+                    raise error
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
     async def make_request(self, req_json: dict):
-        async with self.session.post(self.node_url ,json=req_json, timeout=300) as resp:
-            respJson = await resp.json()
-            if resp.status != 200:
-                self.logger.error(f"RPC request failed with status {resp.status}")
-                self.logger.error(f"Request: {req_json}")
-                self.logger.error(f"Response: {respJson}")
-            return respJson
+        """Make a request to the node, raises NodeUnavailableException right away if no node is healthy"""
+        urls = self.get_nodes(req_json['action'])
+        if len(urls) == 0:
+            raise NodeUnavailableException(f"No node available for {req_json['action']}")
+        elif req_json['action'] in READ_ACTIONS:
+            return await self.hedged_request(urls, req_json)
+        return await self.request_node(urls[0], req_json)
+
+    async def batched_request(self, action: str, account: str, params: dict = {}):
+        """Queue a lookup for account, lookups with the same action and params made
+        within BATCH_WINDOW of each other are sent to the node as a single request.
+        Returns this account's entry from the bulk response"""
+        key = (action, tuple(sorted(params.items())))
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = {}
+            asyncio.get_event_loop().call_later(BATCH_WINDOW, lambda: asyncio.ensure_future(self.flush_batch(key)))
+        if account not in batch:
+            batch[account] = asyncio.get_event_loop().create_future()
+        # Shield so a cancelled caller doesn't cancel the result for everybody else
+        return await asyncio.shield(batch[account])
+
+    @staticmethod
+    def parse_batch_results(action: str, accounts: List[str], respjson: dict) -> dict:
+        """Entries per account of a bulk response, accounts_balances returns "balances" and accounts_pending "blocks".
+            Accounts that were never opened have no balance entry (newer nodes list them under "errors"), they hold nothing"""
+        results = respjson.get('balances', respjson.get('blocks', {}))
+        if not isinstance(results, dict):
+            results = {}
+        if action == 'accounts_balances' and 'balances' in respjson:
+            for account in accounts:
+                if not isinstance(results.get(account), dict):
+                    results[account] = {'balance': '0', 'pending': '0', 'receivable': '0'}
+        return results
+
+    async def flush_batch(self, key: tuple):
+        """Send a gathered batch and hand each waiting caller its result"""
+        action, params = key
+        batch = self.batches.pop(key, {})
+        accounts = list(batch.keys())
+        for i in range(0, len(accounts), BATCH_MAX_ACCOUNTS):
+            chunk = accounts[i:i + BATCH_MAX_ACCOUNTS]
+            req_json = {
+                'action': action,
+                'accounts': chunk
+            }
+            req_json.update(dict(params))
+            try:
+                results = RPCClient.parse_batch_results(action, chunk, await self.make_request(req_json))
+            except Exception as e:
+                for a in chunk:
+                    if not batch[a].done():
+                        batch[a].set_exception(e)
+                continue
+            for a in chunk:
+                if not batch[a].done():
+                    batch[a].set_result(results.get(a, None))
 
     async def account_create(self) -> str:
         account_create = {
@@ -49,14 +253,22 @@ class RPCClient(object):
             return respjson['account']
         return None
 
-    async def account_balance(self, account: str, include_only_confirmed: bool) -> dict:
-        account_balance = {
-            'action': 'account_balance',
-            'account': account,
-            'include_only_confirmed': include_only_confirmed
+    async def accounts_create(self, count: int) -> List[str]:
+        """Create count accounts in the wallet at once"""
+        accounts_create = {
+            'action': 'accounts_create',
+            'wallet': self.wallet_id,
+            'count': count
         }
-        respjson = await self.make_request(account_balance)
-        if 'balance' in respjson:
+        respjson = await self.make_request(accounts_create)
+        if 'accounts' in respjson:
+            return respjson['accounts']
+        return None
+
+    async def account_balance(self, account: str, include_only_confirmed: bool) -> dict:
+        """Balance of account, concurrent calls are coalesced into one accounts_balances request"""
+        respjson = await self.batched_request('accounts_balances', account, {'include_only_confirmed': include_only_confirmed})
+        if isinstance(respjson, dict) and 'balance' in respjson:
             return respjson
         return None
 
@@ -78,16 +290,34 @@ class RPCClient(object):
         return None
 
     async def pending(self, account: str, count: int = 5) -> List[str]:
-        """Return a list of pending blocks"""
+        """Return a list of pending blocks, concurrent calls are coalesced into one accounts_pending request"""
+        blocks = await self.batched_request('accounts_pending', account, {'count': count})
+        if blocks is None:
+            return None
+        # Accounts with nothing pending come back as an empty string
+        return list(blocks) if blocks else []
+
+    async def accounts_pending(self, accounts: List[str], count: int = 5, threshold: int = 0) -> dict:
+        """Return pending blocks of many accounts at once, leaving out blocks smaller than threshold,
+            as a dict of account: {hash: amount} with amounts in raw"""
         pending_action = {
-            'action': 'pending',
-            'account': account,
-            'count': count
+            'action': 'accounts_pending',
+            'accounts': accounts,
+            'count': count,
+            'source': True
         }
+        if threshold > 0:
+            pending_action['threshold'] = str(threshold)
         respjson = await self.make_request(pending_action)
-        if 'blocks' in respjson:
-            return respjson['blocks']
-        return None
+        if 'blocks' not in respjson:
+            return None
+        ret = {}
+        for account, blocks in respjson['blocks'].items():
+            # Accounts with nothing pending come back as an empty string
+            if not blocks:
+                continue
+            ret[account] = {h: int(b['amount'] if isinstance(b, dict) else b) for h, b in blocks.items()}
+        return ret
 
     async def receive(self, account: str, hash: str) -> str:
         """Receive a block and return hash of receive block if successful"""
@@ -115,6 +345,17 @@ class RPCClient(object):
             return respjson
         return None
 
+    async def accounts_representatives(self, accounts: List[str]) -> dict:
+        """Return a dict of account: representative for accounts that are open"""
+        reps_action = {
+            'action': 'accounts_representatives',
+            'accounts': accounts
+        }
+        respjson = await self.make_request(reps_action)
+        if 'representatives' in respjson:
+            return respjson['representatives']
+        return None
+
     async def account_representative_set(self, account: str, rep: str) -> str:
         rep_action = {
             "action": "account_representative_set",
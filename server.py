@@ -2,7 +2,9 @@ from aiohttp import web
 from db.models.account import Account
 from db.models.user import User
 from db.redis import RedisDB
+from rpc.balance_cache import BalanceCache
 from models.constants import Constants
+from tasks.receive_scheduler import ReceiveScheduler
 from util.env import Env
 from util.regex import RegexUtil, AddressMissingException, AddressAmbiguousException
 
@@ -62,8 +64,6 @@ class GrahamServer(object):
             # If not, return an HTTP 401 Unauthorized response
             raise web.HTTPUnauthorized(reason="Invalid or missing API key.")
 
-        redis = await RedisDB.instance().get_redis()
-
         if 'server_id' not in request.match_info:
             return web.HTTPBadRequest(reason='server_id is required')
         try:
@@ -71,24 +71,8 @@ class GrahamServer(object):
         except ValueError:
             return web.HTTPBadRequest(reason='server_id must be an integer')
 
-        # Get all activity stats from DB
-        users_list = []
-        async for key in redis.iscan(match=f"*activity:{server_id}*"):
-            u = await redis.get(key)
-            if u is not None:
-                users_list.append(json.loads(u))
-
-        if len(users_list) == 0:
-            return web.json_response(
-                data=[],
-                dumps=json.dumps
-            )
-
         # Get IDs that meet requirements
-        users_filtered = []
-        for u in users_list:
-            if u['msg_count'] >= Constants.RAIN_MSG_REQUIREMENT:
-                users_filtered.append(u['user_id'])
+        users_filtered = await RedisDB.instance().get_active_user_ids(server_id, Constants.RAIN_MSG_REQUIREMENT)
 
         if len(users_filtered) < 1:
             return web.json_response(
@@ -247,6 +231,10 @@ class GrahamServer(object):
                     account = await Account.filter(address=link).prefetch_related('user').first()
                     if account is None:
                         return web.HTTPOk()
+                    await BalanceCache.instance().invalidate(account.address)
+                    # Have the bot receive it right away, unless it's dust
+                    if int(request_json['amount']) >= ReceiveScheduler.instance().threshold:
+                        await ReceiveScheduler.instance().put(account.address)
                     # See if this is an internal TX
                     transaction = await Transaction.filter(block_hash=hash).prefetch_related('receiving_user').first()
                     if transaction is not None and transaction.receiving_user is not None:
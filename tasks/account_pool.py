@@ -0,0 +1,48 @@
+import asyncio
+import logging
+
+from config import Config
+from db.models.account import PooledAccount
+from rpc.client import RPCClient
+
+# Seconds between checks of the pool size
+REFILL_INTERVAL = 30
+
+class AccountPool(object):
+    """Keeps the pool of pre-created wallet accounts topped up"""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls) -> 'AccountPool':
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.size = Config.instance().get_account_pool_size()
+            cls.logger = logging.getLogger()
+        return cls._instance
+
+    async def refill(self) -> int:
+        """Create accounts for the pool if it's running low, returns number of accounts added"""
+        missing = self.size - await PooledAccount.all().count()
+        if missing <= 0:
+            return 0
+        addresses = await RPCClient.instance().accounts_create(missing)
+        if not addresses:
+            self.logger.error("Couldn't create accounts for the account pool")
+            return 0
+        await PooledAccount.add(addresses)
+        return len(addresses)
+
+    async def refill_loop(self):
+        if self.size <= 0:
+            return
+        while True:
+            try:
+                added = await self.refill()
+                if added > 0:
+                    self.logger.info(f"Added {added} accounts to the account pool")
+            except Exception:
+                self.logger.exception("Error refilling account pool")
+            await asyncio.sleep(REFILL_INTERVAL)
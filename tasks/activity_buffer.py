@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import time
+
+from config import Config
+from db.redis import RedisDB
+from models.constants import Constants
+
+class ActivityBuffer(object):
+    """Coalesces chat activity in memory and writes it to redis in batches.
+
+    Only the first and last message a user sends in a flush window are kept,
+    the flush interval is well under the 90s activity cooldown so at most one
+    message per user per window could ever count anyway."""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls) -> 'ActivityBuffer':
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.pending = {}
+            cls.flush_interval = Config.instance().get_activity_flush_interval()
+            cls.logger = logging.getLogger()
+        return cls._instance
+
+    def add(self, guild_id: int, user_id: int):
+        """Record a chat message from user in guild"""
+        now = time.time()
+        guild_activity = self.pending.setdefault(guild_id, {})
+        if user_id in guild_activity:
+            guild_activity[user_id] = (guild_activity[user_id][0], now)
+        else:
+            guild_activity[user_id] = (now, now)
+
+    async def flush(self, guild_id: int = None):
+        """Write buffered activity to redis, for a single guild if specified"""
+        guild_ids = list(self.pending.keys()) if guild_id is None else [guild_id]
+        for gid in guild_ids:
+            activity = self.pending.pop(gid, None)
+            if activity:
+                await RedisDB.instance().update_activity(gid, activity, Constants.RAIN_MSG_REQUIREMENT * 2)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                self.logger.exception("Error flushing activity buffer")
@@ -0,0 +1,88 @@
+import logging
+
+import config
+import discord
+from discord.ext.commands import Bot
+
+from db.models.user import User
+from db.redis import RedisDB
+from typing import List
+
+class Cluster(object):
+    """Coordination between the bot processes when the shards are spread over several of them.
+
+    Every process sees only the guilds of its own shards, so anything that has to reach
+    another guild or another process' memory goes through redis pub/sub"""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls, bot: Bot = None) -> 'Cluster':
+        if cls._instance is None and bot is None:
+            raise ValueError("bot cannot be None on first call")
+        elif cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.bot = bot
+            cls.logger = logging.getLogger()
+        return cls._instance
+
+    async def announce(self, channel_ids: List[int], embed: discord.Embed):
+        """Post in channels, whichever process can see them"""
+        if len(channel_ids) > 0:
+            await RedisDB.instance().publish_event('announce', channel_ids=channel_ids, embed=embed.to_dict())
+
+    async def on_announce(self, channel_ids: List[int], embed: dict):
+        embed = discord.Embed.from_dict(embed)
+        for channel_id in channel_ids:
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                continue
+            try:
+                await channel.send(embed=embed)
+            except Exception:
+                pass
+
+    async def get_member(self, guild_id: int, user_id: int) -> discord.Member:
+        """A user's membership of a guild, None if they aren't in it.
+            Guilds on shards run by other processes are looked up through the API"""
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None:
+            return guild.get_member(user_id)
+        try:
+            guild = await self.bot.fetch_guild(guild_id)
+            return await guild.fetch_member(user_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+    def get_admin_role_holders(self, guild: discord.Guild) -> List[int]:
+        admin_roles = config.Config.instance().get_admin_roles()
+        return list({m.id for r in guild.roles if r.id in admin_roles for m in r.members})
+
+    async def sync_admin_roles(self, guild: discord.Guild):
+        """Publish who holds an admin role in one of this process' guilds"""
+        await RedisDB.instance().admin_roles_set(guild.id, self.get_admin_role_holders(guild))
+
+    async def update_admin_roles(self, member: discord.Member, has_role: bool = None):
+        if has_role is None:
+            admin_roles = config.Config.instance().get_admin_roles()
+            has_role = any(r.id in admin_roles for r in member.roles)
+        await RedisDB.instance().admin_roles_update(member.guild.id, member.id, has_role)
+
+    async def is_role_admin(self, user_id: int) -> bool:
+        """Whether a user holds an admin role in any guild, including those served by other processes"""
+        return await RedisDB.instance().has_admin_role(user_id)
+
+    async def listen(self):
+        """Handle events published by any process, including this one"""
+        channel = await RedisDB.instance().subscribe_events()
+        while await channel.wait_message():
+            try:
+                msg = await channel.get_json()
+                if msg['event'] == 'invalidate_users':
+                    User.drop_cached(msg['user_ids'])
+                elif msg['event'] == 'announce':
+                    await self.on_announce(msg['channel_ids'], msg['embed'])
+            except Exception:
+                self.logger.exception("Error handling cluster event")
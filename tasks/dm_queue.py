@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+import discord
+from discord.ext.commands import Bot
+
+from config import Config
+from db.redis import RedisDB
+from util.util import Utils
+
+# Seconds a taken recipient is reserved for its sender, undelivered messages are queued again after this
+DM_LEASE = 300
+
+class DMQueue(object):
+    """Delivers direct messages in the background.
+
+    The queue lives in redis so notifications survive restarts, and taken messages stay
+    there until they're delivered so a crash or a change of leader doesn't lose them.
+    Messages to the same recipient that are still waiting are combined into one DM, and
+    delivery runs with bounded concurrency at a steady pace to stay clear of discord's rate limits."""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls, bot: Bot = None) -> 'DMQueue':
+        if cls._instance is None and bot is None:
+            raise ValueError("bot cannot be None on first call")
+        elif cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.bot = bot
+            cls.concurrency = max(1, Config.instance().get_dm_concurrency())
+            cls.interval = 1 / max(0.1, Config.instance().get_dm_rate())
+            cls.next_send = 0
+            cls.wakeup = asyncio.Event()
+            cls.logger = logging.getLogger()
+        return cls._instance
+
+    async def put(self, user_id: int, message: str):
+        """Queue a DM to a user"""
+        await RedisDB.instance().dm_enqueue(user_id, message)
+        self.wakeup.set()
+
+    async def take(self):
+        """Take the next recipient and their messages off the queue, None if it's empty"""
+        return await RedisDB.instance().dm_take(DM_LEASE)
+
+    async def pace(self):
+        """Wait for the next send slot"""
+        now = time.monotonic()
+        wait = self.next_send - now
+        self.next_send = max(now, self.next_send) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def deliver(self, user_id: int, messages: list):
+        user = self.bot.get_user(user_id)
+        try:
+            if user is None:
+                user = await self.bot.fetch_user(user_id)
+            for content in Utils.join_messages(messages):
+                await self.pace()
+                await user.send(content)
+        except discord.Forbidden:
+            # User has blocked the bot or doesn't allow DMs
+            pass
+        except discord.NotFound:
+            pass
+        except Exception:
+            self.logger.exception(f"Failed to deliver DM to {user_id}")
+        # Not reached if the sender is cancelled, the messages are then queued again once the lease runs out
+        await RedisDB.instance().dm_ack(user_id)
+
+    async def queue_consumer(self):
+        self.logger.info(f"Starting DM queue with {self.concurrency} senders")
+        await asyncio.gather(*[self.sender() for _ in range(self.concurrency)])
+
+    async def sender(self):
+        while True:
+            try:
+                entry = await self.take()
+                if entry is None:
+                    # Nothing queued, wait to be woken up by put() or poll again shortly
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.deliver(*entry)
+            except Exception:
+                self.logger.exception("Error occured when processing DM queue")
+                await asyncio.sleep(1)
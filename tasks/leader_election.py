@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from aioredis_lock import RedisLock
+from db.redis import RedisDB
+from typing import Callable, Coroutine
+from util.env import Env
+
+# Seconds the leader keeps its lease without renewing it, a standby takes over at most this long after the leader dies
+LEADER_LEASE = 10
+# Seconds between lease renewals, and between attempts of standbys to take over
+LEADER_RENEW_INTERVAL = 2
+
+class LeaderElection(object):
+    """Runs work that must only happen once, like sending transactions, in exactly one bot process.
+
+    Every process competes for a lock in redis that expires unless the holder keeps renewing it.
+    The process holding it runs the registered workers, if it fails to renew in time it stops them
+    and another process takes over."""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls) -> 'LeaderElection':
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.workers = []
+            cls.tasks = []
+            cls.lock = None
+            cls.is_leader = False
+            cls.logger = logging.getLogger()
+        return cls._instance
+
+    def add_worker(self, worker: Callable[[], Coroutine]):
+        """Run worker() while this process is the leader, it's cancelled when leadership is lost"""
+        self.workers.append(worker)
+
+    async def get_lock(self) -> RedisLock:
+        if self.lock is None:
+            self.lock = RedisLock(
+                await RedisDB.instance().get_redis(),
+                key=f"{Env.currency_name().lower()}leader",
+                timeout=LEADER_LEASE,
+                wait_timeout=0
+            )
+        return self.lock
+
+    async def step_up(self):
+        self.is_leader = True
+        self.logger.info("Elected leader, starting workers")
+        self.tasks = [asyncio.create_task(w()) for w in self.workers]
+
+    async def step_down(self):
+        self.is_leader = False
+        self.logger.warning("No longer the leader, stopping workers")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    lock = await self.get_lock()
+                    if self.is_leader:
+                        if not await lock.renew(LEADER_LEASE):
+                            await self.step_down()
+                    elif await lock.acquire(LEADER_LEASE, wait_timeout=0):
+                        await self.step_up()
+                except Exception:
+                    self.logger.exception("Error in leader election")
+                    # Can't tell whether the lease is still ours, better not to run twice
+                    if self.is_leader:
+                        await self.step_down()
+                await asyncio.sleep(LEADER_RENEW_INTERVAL)
+        finally:
+            # Workers can't outlive the renewals
+            if self.is_leader:
+                await self.step_down()
+
+    async def resign(self):
+        """Hand leadership over right away, e.g. when shutting down"""
+        if self.is_leader:
+            await self.step_down()
+        # Only releases the lock if it's still ours
+        if self.lock is not None:
+            await self.lock.release()
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+
+from config import Config
+from db.models.account import Account
+from db.redis import RedisDB
+from rpc.balance_cache import BalanceCache
+from rpc.client import RPCClient, BATCH_MAX_ACCOUNTS
+from typing import Dict, List
+
+# Most pending blocks received per account in one scan
+RECEIVE_MAX_BLOCKS = 20
+# Seconds between queued receives on the same account
+RECEIVE_COOLDOWN = 5
+
+class ReceiveScheduler(object):
+    """Receives pending blocks on bot accounts in the background"""
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError('Call instance() instead')
+
+    @classmethod
+    def instance(cls) -> 'ReceiveScheduler':
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls.interval = Config.instance().get_receive_interval()
+            cls.concurrency = max(1, Config.instance().get_receive_concurrency())
+            cls.threshold = Config.instance().get_receive_threshold()
+            cls.semaphore = asyncio.Semaphore(cls.concurrency)
+            cls.receiving = set()
+            cls.logger = logging.getLogger()
+        return cls._instance
+
+    async def put(self, address: str):
+        """Queue a receive for an account, may be called from any process"""
+        await RedisDB.instance().receive_enqueue(address, RECEIVE_COOLDOWN)
+
+    async def take(self, count: int) -> List[str]:
+        """Take up to count accounts that are due off the queue"""
+        return await RedisDB.instance().receive_take(count, RECEIVE_COOLDOWN)
+
+    async def queue_consumer(self):
+        """Receive accounts queued by deposit callbacks"""
+        while True:
+            try:
+                addresses = await self.take(self.concurrency)
+                if len(addresses) == 0:
+                    await asyncio.sleep(1)
+                    continue
+                for address in addresses:
+                    # Already receiving, check again once that's done
+                    if address in self.receiving:
+                        await self.put(address)
+                await asyncio.gather(*[self.receive_account(a) for a in addresses if a not in self.receiving])
+            except Exception:
+                self.logger.exception("Error occured when processing receive queue")
+                await asyncio.sleep(1)
+
+    async def receive_account(self, address: str, blocks: Dict[str, int] = None) -> int:
+        """Receive pending blocks of an account, largest first. blocks maps hash to raw amount
+            and is looked up from the node if not given, blocks below the threshold are skipped.
+            Returns number of blocks received"""
+        # Blocks on one account chain have to be received one after another
+        if address in self.receiving:
+            return 0
+        self.receiving.add(address)
+        try:
+            async with self.semaphore:
+                if blocks is None:
+                    blocks = (await RPCClient.instance().accounts_pending([address], count=RECEIVE_MAX_BLOCKS, threshold=self.threshold) or {}).get(address, {})
+                received = 0
+                for hash in sorted((h for h in blocks if blocks[h] >= self.threshold), key=blocks.get, reverse=True):
+                    if await RPCClient.instance().receive(address, hash) is not None:
+                        received += 1
+                if received > 0:
+                    await BalanceCache.instance().invalidate(address)
+                return received
+        finally:
+            self.receiving.discard(address)
+
+    async def find_pending(self, addresses: List[str]) -> Dict[str, Dict[str, int]]:
+        """Pending blocks of all addresses, requested from the node in chunks"""
+        pending = {}
+        for i in range(0, len(addresses), BATCH_MAX_ACCOUNTS):
+            resp = await RPCClient.instance().accounts_pending(addresses[i:i + BATCH_MAX_ACCOUNTS], count=RECEIVE_MAX_BLOCKS, threshold=self.threshold)
+            if resp is not None:
+                pending.update(resp)
+        return pending
+
+    async def receive_all(self) -> int:
+        """Receive pending blocks on every account, accounts with the most pending go first.
+            Returns number of blocks received"""
+        addresses = await Account.all().values_list('address', flat=True)
+        pending = await self.find_pending(list(addresses))
+        if len(pending) == 0:
+            return 0
+        # Tasks take the semaphore in the order they're created
+        ordered = sorted(pending.items(), key=lambda p: max(p[1].values()), reverse=True)
+        results = await asyncio.gather(*[self.receive_account(address, blocks) for address, blocks in ordered], return_exceptions=True)
+        received = 0
+        for r in results:
+            if isinstance(r, Exception):
+                self.logger.error(f"Error receiving pending blocks: {r}")
+            else:
+                received += r
+        return received
+
+    async def receive_loop(self):
+        if self.interval <= 0:
+            return
+        while True:
+            try:
+                received = await self.receive_all()
+                if received > 0:
+                    self.logger.info(f"Received {received} pending blocks")
+            except Exception:
+                self.logger.exception("Error receiving pending blocks")
+            await asyncio.sleep(self.interval)
@@ -1,10 +1,25 @@
 import asyncio
+import heapq
+import itertools
 import logging
+import random
+import time
 
+from config import Config
 from discord.ext.commands import Bot
-from db.models.transaction import Transaction
+from db.models.transaction import Transaction, MAX_SEND_ATTEMPTS
+from db.redis import RedisDB
+from typing import List
 from util.env import Env
 
+# Seconds before a failed send is attempted again, doubled on every attempt up to RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 900
+# Seconds between checks for transactions to re-queue
+REDELIVER_INTERVAL = 10
+# Seconds between checks for transactions handed off by other bot processes
+HANDOFF_INTERVAL = 0.5
+
 class TransactionQueue(object):
     _instance = None
 
@@ -17,25 +32,57 @@ class TransactionQueue(object):
             raise ValueError("bot cannot be None on first call")
         elif cls._instance is None:
             cls._instance = cls.__new__(cls)
-            cls.queue = asyncio.Queue(maxsize=0)
+            cls.worker_count = max(1, Config.instance().get_transaction_queue_workers())
+            cls.queues = [asyncio.Queue(maxsize=0) for _ in range(cls.worker_count)]
+            cls.queued = set()
+            # Only the process running queue_consumer sends, others hand transactions to it through redis
+            cls.consuming = False
+            # Failed transactions waiting for their retry, a heap of (due, seq, tx)
+            cls.delayed = []
+            cls.delayed_ids = set()
+            cls.delayed_seq = itertools.count()
+            cls.delayed_wakeup = asyncio.Event()
             cls.logger = logging.getLogger()
             cls.bot = bot
         return cls._instance
 
+    def get_shard(self, tx: Transaction) -> int:
+        """Transactions from the same sending account always land on the same consumer,
+           so blocks on an account chain are published one at a time and in order"""
+        return tx.sending_user_id % self.worker_count
+
     def clear(self):
-        for _ in range(self.queue.qsize()):
-            try:
-                self.queue.get_nowait()
-                self.queue.task_done()
-            except asyncio.QueueEmpty:
-                pass
-            except ValueError:
-                pass
+        for queue in self.queues:
+            while not queue.empty():
+                queue.get_nowait()
+        self.queued.clear()
+        self.delayed.clear()
+        self.delayed_ids.clear()
+
+    def _handoff_key(self) -> str:
+        return f"{Env.currency_name().lower()}txhandoff"
 
     async def put(self, tx: Transaction):
-        queue: asyncio.Queue = self.queue
+        if not self.consuming:
+            redis = await RedisDB.instance().get_redis()
+            await redis.rpush(self._handoff_key(), str(tx.id))
+            return
+        # Already waiting to be sent
+        if tx.id in self.queued or tx.id in self.delayed_ids:
+            return
+        self.queued.add(tx.id)
+        queue: asyncio.Queue = self.queues[self.get_shard(tx)]
         await queue.put(tx)
 
+    async def put_all(self, txs: List[Transaction]):
+        if not self.consuming:
+            if len(txs) > 0:
+                redis = await RedisDB.instance().get_redis()
+                await redis.rpush(self._handoff_key(), *[str(tx.id) for tx in txs])
+            return
+        for tx in txs:
+            await self.put(tx)
+
     async def notify_user(self, tx: Transaction, hash: str):
         if tx.destination == Env.donation_address():
             return
@@ -49,22 +96,92 @@ class TransactionQueue(object):
         else:
             await user.send(f"Withdraw processed: https://blocklattice.io/block/{hash}")
 
+    def get_retry_delay(self, attempts: int) -> float:
+        """Exponential backoff with jitter, so retries after an outage don't all land at once"""
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
     async def retry(self, tx: Transaction):
-        delay = tx.retries + 1 * 5
-        tx.retries += 1
-        await asyncio.sleep(delay)
-        await self.put(tx)
+        """Schedule another attempt of a failed send, or give up on it after MAX_SEND_ATTEMPTS"""
+        if tx.attempts + 1 >= MAX_SEND_ATTEMPTS:
+            await tx.move_to_dead_letters()
+            self.logger.error(f"Transaction {tx.id} failed {tx.attempts} times, moved to dead letters")
+            return
+        delay = self.get_retry_delay(tx.attempts + 1)
+        await tx.fail(delay)
+        heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.delayed_seq), tx))
+        self.delayed_ids.add(tx.id)
+        self.delayed_wakeup.set()
+
+    async def delay_scheduler(self):
+        """Queue failed transactions once their retry is due"""
+        while True:
+            try:
+                self.delayed_wakeup.clear()
+                timeout = None
+                while len(self.delayed) > 0:
+                    due, _, tx = self.delayed[0]
+                    timeout = due - time.monotonic()
+                    if timeout > 0:
+                        break
+                    heapq.heappop(self.delayed)
+                    self.delayed_ids.discard(tx.id)
+                    await self.put(tx)
+                    timeout = None
+                # Sleep until the next retry is due, or something earlier is scheduled
+                try:
+                    await asyncio.wait_for(self.delayed_wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception:
+                self.logger.exception("Error occured when scheduling transaction retries")
+                await asyncio.sleep(1)
 
     async def queue_consumer(self):
-        queue: asyncio.Queue = self.queue
+        """Start one consumer per shard, unrelated accounts send in parallel"""
+        self.logger.info(f"Starting {self.worker_count} transaction queue consumers")
+        self.consuming = True
+        try:
+            await asyncio.gather(self.delay_scheduler(), self.handoff_consumer(), *[self.shard_consumer(queue) for queue in self.queues])
+        finally:
+            # Stopped, e.g. because another process took over. It finds everything left here in the database
+            self.consuming = False
+            self.clear()
+
+    async def handoff_consumer(self):
+        """Queue transactions created by other bot processes"""
+        key = self._handoff_key()
+        while True:
+            try:
+                redis = await RedisDB.instance().get_redis()
+                tr = redis.multi_exec()
+                tr.lrange(key, 0, 999)
+                tr.ltrim(key, 1000, -1)
+                tx_ids, _ = await tr.execute()
+                if len(tx_ids) == 0:
+                    await asyncio.sleep(HANDOFF_INTERVAL)
+                    continue
+                for tx in await Transaction.filter(id__in=tx_ids, block_hash=None).prefetch_related('sending_user', 'receiving_user'):
+                    await self.put(tx)
+            except Exception:
+                self.logger.exception("Error occured when processing transaction handoff")
+                await asyncio.sleep(1)
+
+    async def shard_consumer(self, queue: asyncio.Queue):
         while True:
             try:
                 tx: Transaction = await queue.get()
-                res = await tx.send()
+                self.queued.discard(tx.id)
+                # Sent already, or being sent by somebody else
+                if not await tx.claim():
+                    continue
+                try:
+                    res = await tx.send()
+                except Exception:
+                    self.logger.exception(f"Error sending transaction {tx.id}")
+                    res = None
                 if res is None:
-                    if tx.retries < 20:
-                        # Retry this transaction by placing it on the end of the queue
-                        asyncio.ensure_future(self.retry(tx))
+                    await self.retry(tx)
                 elif tx.receiving_user is None:
                     # Notify user their withdraw was processed
                     asyncio.ensure_future(self.notify_user(tx=tx, hash=res))
@@ -72,3 +189,16 @@ class TransactionQueue(object):
                 break
             except Exception:
                 self.logger.exception("Error occured when processing transaction queue")
+
+    async def redeliver_loop(self):
+        """Queue transactions whose consumer went away once their lease expires"""
+        while True:
+            await asyncio.sleep(REDELIVER_INTERVAL)
+            try:
+                expired = await Transaction.get_expired()
+                for tx in expired:
+                    await self.put(tx)
+                if len(expired) > 0:
+                    self.logger.info(f"Re-queued {len(expired)} transactions")
+            except Exception:
+                self.logger.exception("Error re-queueing transactions")
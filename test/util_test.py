@@ -1,6 +1,11 @@
 import asyncio
 import unittest
 import os
+from unittest import mock
+from rpc.circuit_breaker import CircuitBreaker
+from rpc.client import RPCClient
+from tortoise import Tortoise
+from util.cache import LRUCache
 from util.conversions import BananoConversions, NanoConversions
 from util.env import Env
 from util.regex import RegexUtil, AmountAmbiguousException, AmountMissingException, AddressAmbiguousException, AddressMissingException
@@ -123,6 +128,13 @@ class TestGenericUtil(unittest.TestCase):
         self.assertEqual(self.b, 2)
         self.assertEqual(self.c, 3)
 
+    def test_join_messages(self):
+        self.assertEqual(Utils.join_messages(["a", "b"]), ["a\n\nb"])
+        self.assertEqual(Utils.join_messages(["aaaa", "bbbb"], limit=8), ["aaaa", "bbbb"])
+        self.assertEqual(Utils.join_messages(["aaaaaaaaaa", "b"], limit=5), ["aaaaa", "aaaaa", "b"])
+        self.assertEqual(Utils.join_messages(["aaaaaaa", "b"], limit=5), ["aaaaa", "aa\n\nb"])
+        self.assertEqual(Utils.join_messages([]), [])
+
     def test_random_float(self):
         rand1 = Utils.random_float()
         rand2 = Utils.random_float()
@@ -132,6 +144,93 @@ class TestGenericUtil(unittest.TestCase):
         self.assertGreaterEqual(rand1, 0)
         self.assertGreaterEqual(rand2, 0)
 
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+        # 2 was used least recently
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(len(cache), 2)
+        cache.pop(1)
+        self.assertNotIn(1, cache)
+
+    def test_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=10)
+        with mock.patch('time.monotonic', return_value=100):
+            cache.put(1, 'a')
+        with mock.patch('time.monotonic', return_value=109):
+            self.assertEqual(cache.get(1), 'a')
+        with mock.patch('time.monotonic', return_value=111):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open_and_recover(self):
+        breaker = CircuitBreaker()
+        with mock.patch('time.monotonic', return_value=100):
+            for _ in range(4):
+                breaker.record_success(0.1)
+            for _ in range(3):
+                breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow())
+        with mock.patch('time.monotonic', return_value=131):
+            # Only one trial request once it's half open
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with mock.patch('time.monotonic', return_value=162):
+            self.assertTrue(breaker.allow())
+            breaker.record_success(0.1)
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            self.assertEqual(breaker.error_rate, 0)
+
+class TestRPCClient(unittest.TestCase):
+    def test_unopened_account_balances(self):
+        resp = {
+            'balances': {
+                'nano_1opened': {'balance': '10', 'pending': '5', 'receivable': '5'}
+            },
+            'errors': {
+                'nano_1unopened': 'Account not found'
+            }
+        }
+        results = RPCClient.parse_batch_results('accounts_balances', ['nano_1opened', 'nano_1unopened', 'nano_1missing'], resp)
+        self.assertEqual(results['nano_1opened']['balance'], '10')
+        self.assertEqual(results['nano_1unopened']['balance'], '0')
+        self.assertEqual(results['nano_1missing']['pending'], '0')
+        # A failed request isn't mistaken for empty accounts
+        self.assertEqual(RPCClient.parse_batch_results('accounts_balances', ['nano_1opened'], {'error': 'Unable to parse JSON'}), {})
+
+class TestRawAmountField(unittest.TestCase):
+    @async_test
+    async def test_sqlite_round_trip(self):
+        from db.tortoise_config import DBConfig
+        from db.models.user import User
+        from db.models.transaction import Transaction
+        await Tortoise.init(db_url='sqlite://:memory:', modules=DBConfig().modules)
+        try:
+            await Tortoise.generate_schemas()
+            # Beyond what a 64-bit integer holds
+            amount = 2**63 + 12345678901234567890
+            user = await User.create(id=1, name='test', pending_send_raw=amount)
+            tx = await Transaction.create(sending_user=user, amount=str(amount), amount_raw=amount)
+            self.assertEqual((await Transaction.get(id=tx.id)).amount_raw, amount)
+            self.assertEqual(await Transaction.filter(amount_raw=amount).count(), 1)
+            self.assertEqual((await User.get(id=1)).pending_send_raw, amount)
+            rows = await Tortoise.get_connection('default').execute_query_dict("SELECT amount_raw FROM transactions")
+            self.assertEqual(rows[0]['amount_raw'], str(amount))
+        finally:
+            await Tortoise.close_connections()
+
 class TestValidators(unittest.TestCase):
     def test_too_many_decimalse(self):
         os.environ['BANANO'] = '1'
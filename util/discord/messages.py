@@ -1,6 +1,7 @@
 import config
 import discord
 from models.command import CommandInfo
+from tasks.dm_queue import DMQueue
 from util.env import Env
 
 class Messages():
@@ -56,14 +57,11 @@ class Messages():
             return None
 
     @staticmethod
-    async def send_basic_dm(member: discord.Member, message: str, skip_dnd=False) -> discord.Message:
-        if skip_dnd and member is not None and member.status == discord.Status.dnd:
-            return None
-        try:
-            return await member.send(message)
-        except Exception:
-            # May raise if user has blocked the bot
+    async def send_basic_dm(member: discord.Member, message: str, skip_dnd=False):
+        """Queue a DM, it's delivered in the background and combined with others waiting for the same user"""
+        if member is None or (skip_dnd and member.status == discord.Status.dnd):
             return None
+        await DMQueue.instance().put(member.id, message)
 
     @staticmethod
     async def add_tip_reaction(msg: discord.Message, amount: float, rain: bool = False):
@@ -26,6 +26,20 @@ class Utils(object):
         for t in task_list:
             await t
 
+    @staticmethod
+    def join_messages(messages: List[str], limit: int = 2000) -> List[str]:
+        """Combine messages into as few as possible, each no longer than limit"""
+        ret = []
+        for message in messages:
+            while len(message) > limit:
+                ret.append(message[:limit])
+                message = message[limit:]
+            if len(ret) > 0 and len(ret[-1]) + len(message) + 2 <= limit:
+                ret[-1] += f"\n\n{message}"
+            else:
+                ret.append(message)
+        return ret
+
     @staticmethod
     def random_float() -> float:
         return secrets.randbelow(100) / 100
\ No newline at end of file